@@ -0,0 +1,52 @@
+"""
+Throughput and output size of the decimation strategies of glplot on
+synthetic traces from ephyview.create_trace: plain striding, min/max
+decimation, M4 and LTTB, for a display of a given pixel width.
+
+Usage: python benchdecimation.py [seconds] [channels] [width]
+"""
+import sys
+import time
+import numpy as np
+from ephyview import create_trace
+from glplot.h5 import minmax_decimate
+from glplot.decimation import m4, lttb, LTTB_POINTS_PER_COLUMN
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.  # in seconds
+channels = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+width = int(sys.argv[3]) if len(sys.argv) > 3 else 1200  # in pixels
+freq = 20000.
+
+y = create_trace(int(duration * freq), channels)
+n = y.shape[0]
+factor = int(np.ceil(n / float(width)))
+
+# each strategy returns the number of points per channel
+def stride(y):
+    # about as many points as M4
+    return np.array(y[::max(1, factor // 4)]).shape[0]
+
+def minmax(y):
+    ymin, ymax = minmax_decimate(y, y, factor)
+    return 2 * ymin.shape[0]
+
+def m4_(y):
+    return m4(y, width)[1].shape[0]
+
+def lttb_(y):
+    return lttb(y, LTTB_POINTS_PER_COLUMN * width)[1].shape[0]
+
+STRATEGIES = [("stride", stride), ("minmax", minmax), ("m4", m4_),
+              ("lttb", lttb_)]
+
+print "%d samples x %d channels, %d pixels" % (n, channels, width)
+print "%-8s %10s %12s %14s" % ("", "time (ms)", "Msamples/s", "points/channel")
+for name, fun in STRATEGIES:
+    fun(y)  # warm up
+    repeat = 5
+    t0 = time.time()
+    for _ in xrange(repeat):
+        npoints = fun(y)
+    dt = (time.time() - t0) / repeat
+    print "%-8s %10.1f %12.1f %14d" % (name, dt * 1000,
+                                       n * channels / dt / 1e6, npoints)
@@ -5,6 +5,7 @@ import tables as tb
 import galry.pyplot as plt
 from galry import Visual, process_coordinates, get_next_color, get_color
 from qtools import inthread
+from glplot.h5 import iter_minmax_levels, PYRAMID, ChannelStats
 
 MAXSIZE = 5000
 CHANNEL_HEIGHT = .25
@@ -92,7 +93,7 @@ def get_view(total_size, xlim, freq):
     # Viewport.
     x0, x1 = xlim
     d = x1 - x0
-    dmax = duration
+    dmax = (total_size - 1) / float(freq)
     zoom = max(dmax / d, 1)
     view_size = total_size / zoom
     step = int(np.ceil(view_size / MAXSIZE))
@@ -103,36 +104,82 @@ def get_view(total_size, xlim, freq):
     i1 = np.clip(int(np.round(x1ex * freq)), 0, total_size)
     return (x0ex, x1ex), slice(i0, i1, step)
 
-def get_undersampled_data(data, xlim, slice):
+def get_gain(data):
+    """Return the gain which brings the data into [-1, 1], from the min and
+    max saved in the attributes of the data, or from the int16 range."""
+    if 'min' in data.attrs and 'max' in data.attrs:
+        # in float64, since abs(-32768) overflows in int16
+        amin = np.asarray(data.attrs.min, dtype=np.float64)
+        amax = np.asarray(data.attrs.max, dtype=np.float64)
+        amax = max(np.abs(amin).max(), np.abs(amax).max())
+        if amax > 0:
+            return 1. / amax
+    return 1. / 32768
+
+def get_undersampled_data(data, xlim, slice, duration, duration_initial,
+                          levels=(), decimator=None, gain=None):
     """
     Arguments:
     
       * data: a HDF5 dataset of size Nsamples x Nchannels.
       * xlim: (x0, x1) of the current data view.
+      * duration: duration of the data, in seconds.
+      * duration_initial: duration of the initial view, in seconds, which
+        spans [-1, 1].
+      * levels: list of (factor, dataset) min/max levels of the data.
+      * decimator: optional glplot.paralleldecimation.ParallelDecimator,
+        used to M4-decimate the raw data in parallel instead of striding.
+      * gain: factor applied to the samples, by default get_gain(data).
       
     """
-    # total_size = data.shape[0]
+    if gain is None:
+        gain = get_gain(data)
+    total_size = data.shape[0]
     # Get the view slice.
     # x0ex, x1ex = xlim
     # x0d, x1d = x0ex / (duration_initial) * 2 - 1, x1ex / (duration_initial) * 2 - 1
+    # Use the coarsest min/max level with at least one row per step: each
+    # level row corresponds to factor / 2 data rows.
+    source, ratio = data, 1.
+    for factor, level in levels:
+        if factor / 2. <= slice.step:
+            source, ratio = level, factor / 2.
+    if source is data:
+        start, stop, step = slice.start, slice.stop, slice.step
+    else:
+        # keep all the rows of the level, so that min and max alternate
+        start, stop, step = 2 * int(slice.start / (2 * ratio)), \
+                            int(np.ceil(slice.stop / ratio)), 1
     # Extract the samples from the data (HDD access).
-    samples = data[slice, :]
+    if decimator is not None and source is data and step > 1:
+        # M4 decimation of all the rows, with as many points as striding
+        width = max(1, len(xrange(start, stop, step)) // 4)
+        indices, samples = decimator.decimate(source[start:stop, :], width)
+    else:
+        samples = source[start:stop:step, :]
+        indices = None
     # Convert the data into floating points.
     samples = np.array(samples, dtype=np.float32)
     # Normalize the data.
-    samples *= (1. / 32768)
+    samples *= gain
     # samples *= .25
     # Size of the slice.
     nsamples, nchannels = samples.shape
     # Create the data array for the plot visual.
-    M = np.empty((nsamples * nchannels, 2))
+    M = np.empty((nsamples * nchannels, 2), dtype=np.float32)
     samples = samples.T# + np.linspace(-1., 1., nchannels).reshape((-1, 1))
     M[:, 1] = samples.ravel()
     # Generate the x coordinates.
-    x = np.arange(slice.start, slice.stop, slice.step) / float(total_size - 1)
+    if indices is None:
+        x = (start + np.arange(nsamples) * step) * ratio / float(total_size - 1)
+    else:
+        # decimated rows, which depend on the channel
+        x = (start + indices.T.ravel()) * ratio / float(total_size - 1)
     # [0, 1] -> [-1, 2*duration.duration_initial - 1]
     x = x * 2 * duration / duration_initial - 1
-    M[:, 0] = np.tile(x, nchannels)
+    if indices is None:
+        x = np.tile(x, nchannels)
+    M[:, 0] = x
     # Update the bounds.
     bounds = np.arange(nchannels + 1) * nsamples
     size = bounds[-1]
@@ -142,9 +189,12 @@ def get_undersampled_data(data, xlim, slice):
 class DataUpdater(object):
     info = {}
     
-    def update(self, data, xlimex, slice):
-        samples, bounds, size = get_undersampled_data(data, xlimex, slice)
+    def update(self, data, xlimex, slice, duration, duration_initial,
+               levels=(), decimator=None, gain=None):
+        samples, bounds, size = get_undersampled_data(data, xlimex, slice,
+            duration, duration_initial, levels, decimator, gain)
         nsamples = samples.shape[0]
+        nchannels = len(bounds) - 1
         color_array_index = np.repeat(np.arange(nchannels), nsamples / nchannels)
         self.info = dict(position0=samples, bounds=bounds, size=size,
             index=color_array_index)
@@ -156,76 +206,93 @@ def create_trace(nsamples, nchannels):
     low = np.array(10000 * np.cos(2*np.pi*5*t), dtype=np.int16)
     return noise + low[:, np.newaxis]
 
-if not os.path.exists('testm.h5'):
-    with tb.openFile('testm.h5', 'w') as f:
-        a = f.createEArray('/', 'data', tb.Int16Atom(), shape=(0,10),
-            chunkshape=(10000, 10))
-        for _ in range(10):
-            a.append(create_trace(100000, 10))
+if __name__ == '__main__':
+    if not os.path.exists('testm.h5'):
+        with tb.openFile('testm.h5', 'w') as f:
+            a = f.createEArray('/', 'data', tb.Int16Atom(), shape=(0,10),
+                chunkshape=(10000, 10))
+            for _ in range(10):
+                a.append(create_trace(100000, 10))
+            # min/max levels, used when zooming out
+            g = f.createGroup('/', 'Pyramid')
+            for factor, level in iter_minmax_levels(a[:], PYRAMID):
+                l = f.createArray(g, 'level%d' % factor, level)
+                l.attrs.factor = factor
+            # statistics of the channels, used for the normalization
+            stats = ChannelStats(a.shape[1], a.dtype)
+            stats.update(a[:])
+            for name in ('min', 'max', 'mean', 'clipped'):
+                setattr(a.attrs, name, getattr(stats, name))
+            a.attrs.std = stats.get_std()
 
-with tb.openFile('testm.h5', 'r') as f:
-    data = f.root.data
+    with tb.openFile('testm.h5', 'r') as f:
+        data = f.root.data
+        levels = []
+        if '/Pyramid' in f:
+            levels = sorted((node.attrs.factor, node) for node in f.root.Pyramid)
             
-    nsamples, nchannels = data.shape
-    total_size = nsamples
-    freq = 10000.
-    dt = 1. / freq
-    duration = (data.shape[0] - 1) * dt
+        nsamples, nchannels = data.shape
+        total_size = nsamples
+        freq = 10000.
+        dt = 1. / freq
+        duration = (data.shape[0] - 1) * dt
+        gain = get_gain(data)
 
-    duration_initial = 5.
+        duration_initial = 5.
 
-    x = np.tile(np.linspace(0., duration, nsamples // MAXSIZE), (nchannels, 1))
-    y = np.zeros_like(x)+ np.linspace(-.9, .9, nchannels).reshape((-1, 1))
+        x = np.tile(np.linspace(0., duration, nsamples // MAXSIZE), (nchannels, 1))
+        y = np.zeros_like(x)+ np.linspace(-.9, .9, nchannels).reshape((-1, 1))
 
-    plt.figure(toolbar=False, show_grid=True)
-    plt.visual(MultiChannelVisual, x=x, y=y)
+        plt.figure(toolbar=False, show_grid=True)
+        plt.visual(MultiChannelVisual, x=x, y=y)
 
-    updater = DataUpdater(impatient=True)
+        updater = DataUpdater(impatient=True)
 
-    SLICE = None
+        SLICE = None
 
-    def change_channel_height(figure, parameter):
-        global CHANNEL_HEIGHT
-        CHANNEL_HEIGHT *= (1 + parameter)
-        figure.set_data(channel_height=CHANNEL_HEIGHT)
+        def change_channel_height(figure, parameter):
+            global CHANNEL_HEIGHT
+            CHANNEL_HEIGHT *= (1 + parameter)
+            figure.set_data(channel_height=CHANNEL_HEIGHT)
 
-    def pan(figure, parameter):
-        figure.process_interaction('Pan', parameter)
+        def pan(figure, parameter):
+            figure.process_interaction('Pan', parameter)
         
-    def anim(figure, parameter):
-        # Constrain the zoom.
-        nav = figure.get_processor('navigation')
-        nav.constrain_navigation = True
-        nav.xmin = -1
-        nav.xmax = 2 * duration / duration_initial
-        nav.sxmin = 1.
+        def anim(figure, parameter):
+            # Constrain the zoom.
+            nav = figure.get_processor('navigation')
+            nav.constrain_navigation = True
+            nav.xmin = -1
+            nav.xmax = 2 * duration / duration_initial
+            nav.sxmin = 1.
         
-        zoom = nav.sx
-        box = nav.get_viewbox()
-        xlim = ((box[0] + 1) / 2. * (duration_initial), (box[2] + 1) / 2. * (duration_initial))
-        xlimex, slice = get_view(data.shape[0], xlim, freq)
+            zoom = nav.sx
+            box = nav.get_viewbox()
+            xlim = ((box[0] + 1) / 2. * (duration_initial), (box[2] + 1) / 2. * (duration_initial))
+            xlimex, slice = get_view(data.shape[0], xlim, freq)
         
-        # Paging system.
-        dur = xlim[1] - xlim[0]
-        index = int(np.floor(xlim[0] / dur))
-        zoom_index = int(np.round(duration_initial / dur))
-        i = (index, zoom_index)
-        global SLICE
-        if i != SLICE:
-            SLICE = i
-            updater.update(data, xlimex, slice)
-        if updater.info:
-            figure.set_data(**updater.info)
-            updater.info.clear()
+            # Paging system.
+            dur = xlim[1] - xlim[0]
+            index = int(np.floor(xlim[0] / dur))
+            zoom_index = int(np.round(duration_initial / dur))
+            i = (index, zoom_index)
+            global SLICE
+            if i != SLICE:
+                SLICE = i
+                updater.update(data, xlimex, slice, duration,
+                               duration_initial, levels, gain=gain)
+            if updater.info:
+                figure.set_data(**updater.info)
+                updater.info.clear()
         
-    plt.animate(anim, dt=.01)
-    plt.action('Wheel', change_channel_height, key_modifier='Control',
-               param_getter=lambda p: p['wheel'] * .001)
-    plt.action('Wheel', pan, key_modifier='Shift',
-               param_getter=lambda p: (p['wheel'] * .002, 0))
-    plt.action('DoubleClick', 'ResetZoom')
+        plt.animate(anim, dt=.01)
+        plt.action('Wheel', change_channel_height, key_modifier='Control',
+                   param_getter=lambda p: p['wheel'] * .001)
+        plt.action('Wheel', pan, key_modifier='Shift',
+                   param_getter=lambda p: (p['wheel'] * .002, 0))
+        plt.action('DoubleClick', 'ResetZoom')
 
-    plt.xlim(0., duration_initial)
+        plt.xlim(0., duration_initial)
 
-    plt.show()
-    # f.close()
+        plt.show()
+        # f.close()
@@ -0,0 +1,255 @@
+import sys
+import time
+import logging
+import threading
+import Queue
+import numpy as np
+from dataproxy import BufferPool
+
+log = logging.getLogger(__name__)
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """
+    Result of an asynchronous request, with the interface of
+    concurrent.futures.Future, which is not in the Python 2 library.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.state = "pending"  # "running", "cancelled" or "finished"
+        self.value = None
+        self.error = None
+        self.traceback = None
+        self.callbacks = []
+
+    def cancel(self):
+        """
+        Cancel the request if it has not started yet. Return True if the
+        request is cancelled.
+        """
+        with self.condition:
+            if self.state in ("running", "finished"):
+                return False
+            if self.state == "cancelled":
+                return True
+            self.state = "cancelled"
+            self.condition.notify_all()
+        self.run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self.state == "cancelled"
+
+    def running(self):
+        return self.state == "running"
+
+    def done(self):
+        return self.state in ("cancelled", "finished")
+
+    def set_running(self):
+        """
+        Called by the worker before running the request. Return False if
+        the request has been cancelled.
+        """
+        with self.condition:
+            if self.state != "pending":
+                return False
+            self.state = "running"
+            return True
+
+    def set_result(self, value):
+        with self.condition:
+            self.value = value
+            self.state = "finished"
+            self.condition.notify_all()
+        self.run_callbacks()
+
+    def set_exception(self, error, traceback=None):
+        """
+        traceback is the one of the error in the worker, which result raises
+        again.
+        """
+        with self.condition:
+            self.error = error
+            self.traceback = traceback
+            self.state = "finished"
+            self.condition.notify_all()
+        self.run_callbacks()
+
+    def wait(self, timeout=None):
+        with self.condition:
+            if timeout is None:
+                while not self.done():
+                    self.condition.wait()
+            else:
+                end = time.time() + timeout
+                while not self.done() and time.time() < end:
+                    self.condition.wait(end - time.time())
+            if self.state == "cancelled":
+                raise CancelledError()
+            if not self.done():
+                raise TimeoutError()
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self.error is not None:
+            raise type(self.error), self.error, self.traceback
+        return self.value
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self.error
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the request is done, from the worker thread, or
+        immediately if it is already done.
+        """
+        with self.condition:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def run_callbacks(self):
+        for fn in self.callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("Future callback failed")
+        self.callbacks = []
+
+
+class ResultRing(object):
+    """
+    Ring of ``count`` preallocated buffers per dtype, which receive the
+    copies of the results, so that loading data buffers does not allocate
+    once the buffers have grown to the size of the results. A copy stays
+    valid until ``count`` more results of its dtype have been copied, so
+    count must exceed the number of results alive at the same time.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.pools = {}
+
+    def copy(self, arr):
+        pool = self.pools.get(arr.dtype)
+        if pool is None:
+            # the buffers grow on first use
+            pool = BufferPool(0, self.count, arr.dtype)
+            self.pools[arr.dtype] = pool
+        out = pool.get(arr.shape)
+        out[...] = arr
+        return out
+
+
+def copy_result(result, ring=None):
+    # the proxies return views on buffers that the next call overwrites;
+    # copied into the buffers of ring if it is not None
+    if isinstance(result, tuple):
+        return (copy_result(result[0], ring),) + result[1:]
+    if isinstance(result, np.ndarray):
+        if ring is not None:
+            return ring.copy(result)
+        return np.array(result)
+    return result
+
+
+class AsyncDataProxy(object):
+    """
+    Asynchronous access to a DataProxy, with a pool of worker threads.
+    request returns a Future of the result of a proxy method. Identical
+    requests in flight share the same Future, and cancel_stale cancels the
+    requests which have not started and are not needed anymore.
+    The methods of dataproxy should not be called directly while requests
+    are in flight.
+    If nresults is not None, the results are copied into a ResultRing of
+    nresults buffers instead of new arrays: a result is then valid until
+    nresults more results have been read.
+    """
+    def __init__(self, dataproxy, workers=2, nresults=None):
+        self.dataproxy = dataproxy
+        self.ring = ResultRing(nresults) if nresults else None
+        self.tasks = Queue.Queue()
+        self.pending = {}  # key: future, for the requests in flight
+        self.lock = threading.Lock()
+        # the proxy methods are not thread-safe, only their prefetch is
+        self.proxylock = threading.Lock()
+        self.threads = []
+        for _ in xrange(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def request(self, databuffer, offsetx=None, channels=None, step=None,
+                method="get", **kwargs):
+        """
+        Request dataproxy.<method>(databuffer, offsetx, channels, step,
+        **kwargs), where method is "get" or "get_yonly" and kwargs their
+        other arguments, such as width or dtype. The result of the Future is
+        a copy of the result of the method, see nresults.
+        """
+        key = (method, tuple(databuffer), offsetx, repr(channels), step,
+               repr(sorted(kwargs.items())))
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None and not future.cancelled():
+                return future
+            future = Future()
+            self.pending[key] = future
+        future.add_done_callback(lambda future: self.remove(key, future))
+        self.tasks.put((future, method, databuffer, offsetx, channels, step,
+                        kwargs))
+        return future
+
+    def remove(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def cancel_stale(self, keep=()):
+        """
+        Cancel the requests in flight which have not started, except the
+        futures in keep. Return the number of cancelled requests.
+        """
+        with self.lock:
+            futures = [future for future in self.pending.itervalues()
+                       if future not in keep]
+        return sum(future.cancel() for future in futures)
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, method, databuffer, offsetx, channels, step, kwargs = task
+            if not future.set_running():
+                continue  # cancelled
+            try:
+                # read the data from disk without holding the lock, so that
+                # several requests can be read at the same time
+                self.dataproxy.prefetch(databuffer, channels=channels,
+                                        step=step)
+                with self.proxylock:
+                    result = getattr(self.dataproxy, method)(databuffer,
+                        offsetx=offsetx, channels=channels, step=step,
+                        **kwargs)
+                    result = copy_result(result, self.ring)
+            except Exception, e:
+                future.set_exception(e, sys.exc_info()[2])
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        self.cancel_stale()
+        for _ in self.threads:
+            self.tasks.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
@@ -0,0 +1,142 @@
+"""
+Convert all the DAT files of a directory tree to HDF5 files, with a pool of
+processes.
+
+Usage: python batchconvert.py -c CHANNELS -f FREQ [options] DIRECTORY
+"""
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from h5 import convert_to_hdf5
+from progressreporting import ProgressReporter
+
+# number of bytes converted so far for each file, shared with the workers
+PROGRESS = None
+
+def find_dat_files(directory):
+    """
+    Return the sorted list of the .dat files in a directory tree.
+    """
+    datfiles = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() == ".dat":
+                datfiles.append(os.path.join(root, name))
+    return sorted(datfiles)
+
+def get_h5_file(datfile):
+    return os.path.splitext(datfile)[0] + ".h5"
+
+def is_up_to_date(datfile, h5file):
+    """
+    An HDF5 file is up to date if it is more recent than its DAT file.
+    Conversions are written to a temporary file which is renamed at the end,
+    so that an interrupted conversion is never taken for a complete one.
+    """
+    return (os.path.exists(h5file) and
+            os.path.getmtime(h5file) >= os.path.getmtime(datfile))
+
+def init_worker(progress):
+    global PROGRESS
+    PROGRESS = progress
+
+def convert_file(args):
+    index, datfile, h5file, channels, freq, dtype, kwargs = args
+    size = os.path.getsize(datfile)
+    def report(elapsed, complete):
+        PROGRESS[index] = complete * size
+    tmpfile = h5file + ".part"
+    # continue an interrupted conversion if asked to, start again otherwise
+    if os.path.exists(tmpfile) and not kwargs.get("resume"):
+        os.remove(tmpfile)
+    try:
+        convert_to_hdf5(datfile, tmpfile, channels, freq, dtype=dtype,
+                        report=ProgressReporter(report, period=1.), **kwargs)
+        os.rename(tmpfile, h5file)
+    except Exception, e:
+        return datfile, "%s: %s" % (e.__class__.__name__, e)
+    return datfile, None
+
+def convert_directory(directory, channels, freq, dtype=None, workers=None,
+                      force=False, **kwargs):
+    """
+    Convert all the DAT files of a directory tree that do not have an up to
+    date HDF5 file, with ``workers`` processes (by default, one per CPU).
+    Other keyword arguments are passed to ``convert_to_hdf5``.
+    Return the list of (datfile, error) for the files that failed.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    datfiles = [datfile for datfile in find_dat_files(directory)
+                if force or not is_up_to_date(datfile, get_h5_file(datfile))]
+    if not datfiles:
+        print "Nothing to convert in <%s>" % directory
+        return []
+    sizes = [os.path.getsize(datfile) for datfile in datfiles]
+    totalsize = float(max(sum(sizes), 1))
+    print "Convert %d files (%.1f GB) with %d workers" % (len(datfiles),
+        totalsize / 1e9, workers)
+
+    progress = multiprocessing.Array('d', len(datfiles))
+    pool = multiprocessing.Pool(workers, init_worker, (progress,))
+    tasks = [(i, datfile, get_h5_file(datfile), channels, freq, dtype, kwargs)
+             for i, datfile in enumerate(datfiles)]
+    # biggest files first, so that the last ones do not delay the end
+    tasks.sort(key=lambda task: -sizes[task[0]])
+    result = pool.map_async(convert_file, tasks, chunksize=1)
+
+    report = ProgressReporter("text")
+    report.start()
+    while not result.ready():
+        result.wait(.5)
+        report.update(min(sum(progress[:]) / totalsize, .999))
+    pool.close()
+    pool.join()
+    report.finish()
+
+    errors = [(datfile, error) for datfile, error in result.get()
+              if error is not None]
+    for datfile, error in errors:
+        print "Failed to convert <%s>: %s" % (datfile, error)
+    return errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert the DAT files of a directory tree to HDF5.")
+    parser.add_argument("directory")
+    parser.add_argument("-c", "--channels", type=int, required=True,
+                        help="number of channels")
+    parser.add_argument("-f", "--freq", type=float, required=True,
+                        help="sampling frequency")
+    parser.add_argument("-d", "--dtype", default="int16",
+                        help="dtype of the DAT files (default: int16)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of processes (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true",
+                        help="convert files even if they are up to date")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted conversions")
+    parser.add_argument("--mmap", action="store_true",
+                        help="use the memory-mapped conversion pipeline")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="write min/max levels next to RawData")
+    parser.add_argument("--stats", action="store_true",
+                        help="save per-channel statistics as attributes")
+    parser.add_argument("--index", action="store_true",
+                        help="create the min/max index of RawData")
+    parser.add_argument("--autotune", action="store_true",
+                        help="choose the chunk shape and compression filter "
+                             "of RawData by benchmarking reads")
+    args = parser.parse_args(argv)
+    errors = convert_directory(args.directory, args.channels, args.freq,
+                               dtype=np.dtype(args.dtype),
+                               workers=args.workers, force=args.force,
+                               mmap=args.mmap, pyramid=args.pyramid,
+                               autotune=args.autotune, stats=args.stats,
+                               resume=args.resume, index=args.index)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Throughput of convert_to_hdf5, with the chunked reader and with the
+memory-mapped, preallocated pipeline, and time to read 3-second windows of
+the converted files. Both modes create RawData with the same chunk shape, so
+that the benchmark compares the pipelines and not the layouts.
+
+Usage: python benchh5.py [size in GB] [channels]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from h5 import convert_to_hdf5, load_hdf5, read_hdf5, close_hdf5
+
+size = float(sys.argv[1]) if len(sys.argv) > 1 else .5  # in GB
+channels = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+freq = 20000.
+dtype = np.dtype(np.int16)
+
+tmpdir = tempfile.mkdtemp()
+datfile = os.path.join(tmpdir, "bench.dat")
+
+# create a synthetic DAT file, 60 seconds at a time
+rows = int(size * 1e9 / (dtype.itemsize * channels))
+chunkrows = int(60 * freq)
+f = open(datfile, "wb")
+for i in xrange(0, rows, chunkrows):
+    n = min(chunkrows, rows - i)
+    x = np.array(np.random.randn(n, channels) * 1000, dtype=dtype)
+    x.tofile(f)
+f.close()
+nbytes = os.path.getsize(datfile)
+
+windows = 50  # number of 3-second windows read in each file
+rnd = np.random.RandomState(0)
+fromtimes = rnd.uniform(0, rows / freq - 3., windows)
+
+results = []
+for name, kwargs in [("read", dict()), ("mmap", dict(mmap=True))]:
+    h5file = os.path.join(tmpdir, "bench_%s.h5" % name)
+    t0 = time.time()
+    convert_to_hdf5(datfile, h5file, channels, freq, dtype=dtype, **kwargs)
+    dt = time.time() - t0
+    data = load_hdf5(h5file)
+    chunks = data.chunks
+    t0 = time.time()
+    for fromtime in fromtimes:
+        read_hdf5(data, fromtime, 3.)
+    dtread = time.time() - t0
+    close_hdf5(data)
+    results.append((name, dt, dtread, chunks))
+    os.remove(h5file)
+os.remove(datfile)
+os.rmdir(tmpdir)
+
+print
+print "%.2f GB, %d channels" % (nbytes / 1e9, channels)
+for name, dt, dtread, chunks in results:
+    print "%-6s %6.2f s  %6.3f GB/s  %6.1f s/GB  " \
+          "%d windows read in %.2f s  chunks %s" % \
+          (name, dt, nbytes / 1e9 / dt, dt / (nbytes / 1e9), windows, dtread,
+           chunks)
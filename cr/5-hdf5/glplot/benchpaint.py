@@ -0,0 +1,66 @@
+"""
+Frame time of DataDisplay.paint with one glDrawArrays call per channel and
+with the batched glMultiDrawArrays path, at 64, 256 and 1024 channels.
+
+Usage: python benchpaint.py [samples per channel] [frames]
+"""
+import sys
+import time
+import numpy as np
+from PyQt4 import QtGui, QtOpenGL
+from OpenGL.GL import glFinish
+from datadisplay import DataDisplay, YDataDisplay
+from colors import LINECOLORS
+
+nsamples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+frames = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+class BenchWidget(QtOpenGL.QGLWidget):
+    def initializeGL(self):
+        self.results = []
+        for layout in ("xy", "y"):
+            for nchannels in (64, 256, 1024):
+                for batched in (False, True):
+                    dt = self.bench(layout, nchannels, batched)
+                    self.results.append((layout, nchannels, batched, dt))
+        
+    def bench(self, layout, nchannels, batched):
+        y = np.array(np.random.randn(nchannels, nsamples), dtype=np.float32)
+        y += np.arange(nchannels).reshape((-1, 1)) * 5
+        databounds = np.arange(nchannels + 1) * nsamples
+        options = [dict(mode="line", lw=1.,
+                        color=LINECOLORS[i % len(LINECOLORS)])
+                   for i in xrange(nchannels)]
+        if layout == "xy":
+            display = DataDisplay()
+            data = np.empty((nchannels * nsamples, 2), dtype=np.float32)
+            data[:, 0] = np.tile(np.linspace(0., 1., nsamples), nchannels)
+            data[:, 1] = y.ravel()
+            display.batched = batched
+            display.load(data, databounds, options)
+        else:
+            display = YDataDisplay()
+            display.batched = batched
+            display.load(y.ravel(), databounds, options,
+                         x=(0., 1. / (nsamples - 1)))
+        display.initialize()
+        display.resize(self.width(), self.height())
+        display.transform(-.5, -.5, 1., 1.)
+        display.paint()
+        glFinish()
+        t0 = time.time()
+        for _ in xrange(frames):
+            display.paint()
+        glFinish()
+        return (time.time() - t0) / frames
+
+app = QtGui.QApplication(sys.argv)
+widget = BenchWidget()
+widget.resize(1024, 768)
+widget.show()
+app.processEvents()
+
+print "%d samples per channel, %d frames" % (nsamples, frames)
+print "%-6s %9s %10s %16s" % ("layout", "channels", "batched", "frame time (ms)")
+for layout, nchannels, batched, dt in widget.results:
+    print "%-6s %9d %10s %16.2f" % (layout, nchannels, batched, dt * 1000)
@@ -0,0 +1,36 @@
+"""
+Scaling of the parallel decimation of high-density probes with the number
+of worker processes.
+
+Usage: python benchparallel.py [channels] [seconds] [width]
+"""
+import sys
+import time
+import numpy as np
+from paralleldecimation import ParallelDecimator
+
+channels = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 3.  # in seconds
+width = int(sys.argv[3]) if len(sys.argv) > 3 else 1200  # in pixels
+freq = 20000.
+repeat = 5
+
+y = np.array(np.random.randn(int(duration * freq), channels) * 1000,
+             dtype=np.float32)
+print "%d samples x %d channels, %d pixels" % (y.shape[0], channels, width)
+print "%-6s %-8s %10s %12s %8s" % ("", "workers", "time (ms)", "Msamples/s",
+                                   "speedup")
+for method in ("m4", "lttb"):
+    reference = None
+    for workers in (1, 2, 4, 8):
+        decimator = ParallelDecimator(workers, size=y.size, dtype=y.dtype)
+        decimator.decimate(y, width, method)  # warm up
+        t0 = time.time()
+        for _ in xrange(repeat):
+            decimator.decimate(y, width, method)
+        dt = (time.time() - t0) / repeat
+        decimator.close()
+        if reference is None:
+            reference = dt
+        print "%-6s %-8d %10.1f %12.1f %8.2f" % (method, workers, dt * 1000,
+            y.size / dt / 1e6, reference / dt)
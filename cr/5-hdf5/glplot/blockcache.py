@@ -0,0 +1,300 @@
+import os
+import time
+import errno
+import atexit
+import itertools
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class BlockCache(object):
+    """
+    Least recently used cache of NumPy arrays, with a memory budget in bytes.
+
+    ``hits`` and ``misses`` count the calls to get which found, or did not
+    find, the requested block, to help choosing the budget.
+    The cache can be shared between threads.
+    """
+    def __init__(self, budget=256 * 2 ** 20):
+        self.budget = budget
+        self.size = 0  # number of bytes in the cache
+        self.blocks = OrderedDict()  # oldest first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.blocks
+
+    def __len__(self):
+        with self.lock:
+            return len(self.blocks)
+
+    def get(self, key):
+        """
+        Return the block with the given key, or None if it is not cached.
+        """
+        with self.lock:
+            block = self.blocks.pop(key, None)
+            if block is None:
+                self.misses += 1
+                return None
+            # most recently used
+            self.blocks[key] = block
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        with self.lock:
+            if key in self.blocks:
+                self.size -= self.blocks.pop(key).nbytes
+            if block.nbytes > self.budget:
+                return
+            self.blocks[key] = block
+            self.size += block.nbytes
+            # evict the least recently used blocks
+            while self.size > self.budget:
+                oldkey, oldblock = self.blocks.popitem(last=False)
+                self.size -= oldblock.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, blocks=len(self.blocks),
+                    size=self.size, budget=self.budget)
+
+
+def get_file_key(filename):
+    """
+    Return a key identifying a file, for the caches shared by the proxies
+    reading the same file, even from different paths. The key changes when
+    the file is modified, so that no stale block is read from the caches.
+    """
+    st = os.stat(filename)
+    return "%s:%d:%d:%r:%d" % (os.path.realpath(filename), st.st_dev,
+                               st.st_ino, st.st_mtime, st.st_size)
+
+def get_shm_directory():
+    # memory-backed file system on Linux
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class SharedBlockCache(object):
+    """
+    Cache of NumPy arrays shared between processes, with the interface of
+    BlockCache. Each block is a .npy file in a memory-backed directory
+    (/dev/shm on Linux), which the processes map in memory, so that the
+    viewers of the same file share a single copy of its blocks. The keys
+    must identify the file, see get_file_key.
+    When the files exceed the budget in bytes, the least recently used
+    ones are deleted. The processes which have mapped them keep them until
+    they unmap them.
+    Each process keeps an index of the files with their size, and scans the
+    directory again, to see the files of the other processes, at most every
+    ``scanperiod`` seconds when it evicts blocks.
+    Since the directory is in RAM, the blocks are deleted when the last
+    cache using it is closed: each cache registers itself with a
+    "<prefix>user-<pid>-<n>" file, removed by close, which is called at
+    exit. The users whose process has died are ignored, and a new cache
+    without any other user deletes the blocks they left. Blocks of a
+    process killed without running its exit handlers stay until then, or
+    until another cache evicts them.
+    """
+    counter = itertools.count()
+    
+    def __init__(self, budget=256 * 2 ** 20, directory=None,
+                 prefix="glplot-", maxmaps=4096, scanperiod=10.):
+        if directory is None:
+            directory = get_shm_directory()
+        self.directory = directory
+        self.prefix = prefix
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.maps = OrderedDict()  # blocks mapped by this process
+        self.maxmaps = maxmaps
+        self.files = OrderedDict()  # path: bytes, least recently used first
+        self.size = 0  # number of bytes in the files
+        self.scanperiod = scanperiod
+        self.scantime = 0.
+        self.lock = threading.RLock()
+        self.userpath = os.path.join(directory, "%suser-%d-%d" % \
+            (prefix, os.getpid(), next(self.counter)))
+        if not self.get_users():
+            self.clear()  # left by the sessions which have died
+        open(self.userpath, "w").close()
+        atexit.register(self.close)
+        self.scan()
+
+    def get_users(self):
+        """
+        Return the user files of the caches whose process is alive, and
+        delete the others.
+        """
+        users = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(self.prefix + "user-"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                pid = int(name.split("-")[-2])
+            except ValueError:
+                continue
+            if is_process_alive(pid):
+                users.append(path)
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # deleted by another process
+        return users
+
+    def close(self):
+        """
+        Unregister this cache, and delete all the blocks if it was the last
+        user of the directory. Called at exit.
+        """
+        with self.lock:
+            if self.userpath is None:
+                return
+            try:
+                os.remove(self.userpath)
+            except OSError:
+                pass
+            self.userpath = None
+            if not self.get_users():
+                self.clear()
+            else:
+                self.maps.clear()
+
+    def get_path(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, self.prefix + name + ".npy")
+
+    def scan(self):
+        """
+        Rebuild the index from the files of the directory, the least
+        recently used first.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(self.prefix) or not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # deleted by another process
+            files.append((st.st_mtime, path, st.st_size))
+        with self.lock:
+            self.files = OrderedDict((path, size)
+                                     for mtime, path, size in sorted(files))
+            self.size = sum(self.files.itervalues())
+            self.scantime = time.time()
+
+    def add_file(self, path, size):
+        # most recently used
+        with self.lock:
+            self.size += size - self.files.pop(path, 0)
+            self.files[path] = size
+
+    def __contains__(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, key):
+        path = self.get_path(key)
+        with self.lock:
+            block = self.maps.pop(path, None)
+            if block is None:
+                if not os.path.exists(path):
+                    self.misses += 1
+                    return None
+                try:
+                    block = np.load(path, mmap_mode="r")
+                except (IOError, ValueError):
+                    # deleted by another process in the meantime
+                    self.misses += 1
+                    return None
+                # most recently used, for the other processes too
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+            self.add_file(path, self.files.get(path, block.nbytes))
+            self.maps[path] = block
+            while len(self.maps) > self.maxmaps:
+                self.maps.popitem(last=False)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        if block.nbytes > self.budget:
+            return
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return
+        # the other processes only see complete blocks
+        fd, tmppath = tempfile.mkstemp(prefix=self.prefix, suffix=".tmp",
+                                       dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, block)
+            size = os.path.getsize(tmppath)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return
+        with self.lock:
+            self.add_file(path, size)
+            if self.size > self.budget:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used blocks beyond the budget.
+        """
+        with self.lock:
+            if time.time() - self.scantime > self.scanperiod:
+                self.scan()
+            while self.size > self.budget and self.files:
+                path, size = self.files.popitem(last=False)
+                self.size -= size
+                self.maps.pop(path, None)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # deleted by another process
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
+            self.scan()
+            for path in self.files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.files.clear()
+            self.size = 0
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, blocks=len(self.files),
+                    size=self.size, budget=self.budget)
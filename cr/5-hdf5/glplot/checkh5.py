@@ -0,0 +1,220 @@
+"""
+Round-trip checks of the HDF5 conversion and of the data read back from it:
+RawData, pyramid, statistics, autotuned layout, min/max index, resumed
+conversion, and the decimated and stepped reads of H5DataProxy. Each check
+raises an AssertionError if the data read back differs from the DAT file.
+
+Usage: python checkh5.py
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from h5 import convert_to_hdf5, load_hdf5, load_pyramid, load_minmax_index, \
+    iter_minmax_levels, minmax_decimate, get_chunk_shape, ChannelStats, PYRAMID
+from dataproxy import H5DataProxy
+from decimation import decimate
+
+channels = 4
+freq = 1000.
+dtype = np.dtype(np.int16)
+rows = 200000
+
+
+def create_dat(filename):
+    rnd = np.random.RandomState(0)
+    t = np.arange(rows) / freq
+    x = 1000 * np.sin(2 * np.pi * t)[:, np.newaxis] + \
+        100 * rnd.randn(rows, channels)
+    x = np.array(x, dtype=dtype)
+    x.tofile(filename)
+    return x
+
+def convert(datfile, h5file, **kwargs):
+    if os.path.exists(h5file):
+        os.remove(h5file)
+    convert_to_hdf5(datfile, h5file, channels, freq, dtype=dtype,
+                    report=open(os.devnull, "w"), **kwargs)
+    return load_hdf5(h5file)
+
+def check_rawdata(x, datfile, h5file):
+    for mmap in (False, True):
+        d = convert(datfile, h5file, mmap=mmap)
+        assert d.shape == x.shape and d.dtype == x.dtype
+        # time-major chunks of all the channels in both modes
+        assert d.chunks == get_chunk_shape(channels, freq, dtype)
+        assert np.array_equal(d[:], x)
+        assert d.attrs["freq"] == freq and d.attrs["channels"] == channels
+        assert d.attrs["lastrow"] == rows
+        d.file.close()
+
+def check_pyramid(x, datfile, h5file):
+    d = convert(datfile, h5file, pyramid=True)
+    levels = load_pyramid(d)
+    assert [factor for factor, level in levels] == sorted(PYRAMID)
+    for (factor, level), (factor2, ref) in zip(levels,
+                                              iter_minmax_levels(x, PYRAMID)):
+        assert np.array_equal(level[:], ref)
+        # min and max of the first block
+        assert np.array_equal(level[0], x[:factor].min(axis=0))
+        assert np.array_equal(level[1], x[:factor].max(axis=0))
+        assert level.attrs["freq"] == 2. * freq / factor
+    d.file.close()
+
+def check_stats(x, datfile, h5file):
+    d = convert(datfile, h5file, stats=True)
+    assert np.array_equal(d.attrs["min"], x.min(axis=0))
+    assert np.array_equal(d.attrs["max"], x.max(axis=0))
+    assert np.allclose(d.attrs["mean"], x.mean(axis=0))
+    assert np.allclose(d.attrs["std"], x.std(axis=0))
+    d.file.close()
+
+def check_autotune(x, datfile, h5file):
+    d = convert(datfile, h5file, autotune=True)
+    assert np.array_equal(d[:], x)
+    # the chosen layout is saved, even without compression
+    assert tuple(d.attrs["chunks"]) == d.chunks
+    assert d.attrs["compression"] == (d.compression or "none")
+    assert d.attrs["shuffle"] == d.shuffle
+    d.file.close()
+
+def check_index(x, datfile, h5file):
+    d = convert(datfile, h5file, index=True)
+    index = load_minmax_index(d)
+    rnd = np.random.RandomState(1)
+    for _ in xrange(100):
+        i0, i1 = sorted(rnd.randint(0, rows, 2))
+        vmin, vmax = index.query(i0, i1)
+        # the range contains the exact one, and is exact on whole blocks
+        assert (vmin <= x[i0:i1 + 1].min(axis=0)).all()
+        assert (vmax >= x[i0:i1 + 1].max(axis=0)).all()
+        b0 = i0 // index.blockrows * index.blockrows
+        b1 = min((i1 // index.blockrows + 1) * index.blockrows, rows)
+        assert np.array_equal(vmin, x[b0:b1].min(axis=0))
+        assert np.array_equal(vmax, x[b0:b1].max(axis=0))
+    # rows beyond the last block are ignored
+    vmin, vmax = index.query(rows - 10, index.nblocks * index.blockrows + 10)
+    assert np.array_equal(vmin, x[-(rows % index.blockrows or
+                                    index.blockrows):].min(axis=0))
+    assert index.query(index.nblocks * index.blockrows, rows + 10) is None
+    d.file.close()
+
+def check_resume(x, datfile, h5file):
+    convert(datfile, h5file, pyramid=True, stats=True).file.close()
+    d = h5py.File(h5file, "r+")["RawData"]
+    levels = load_pyramid(d)
+    ref = dict((factor, level[:]) for factor, level in levels)
+    # interrupted after a chunk, whose rows are a multiple of the factors
+    lastrow = rows // 3
+    lastrow -= lastrow % max(PYRAMID)
+    d[lastrow:] = 0
+    for factor, level in levels:
+        level[2 * (lastrow // factor):] = 0
+    stats = ChannelStats(channels, dtype)
+    stats.update(x[:lastrow])
+    stats.write_attrs(d.attrs)
+    d.attrs["lastrow"] = lastrow
+    d.file.close()
+    convert_to_hdf5(datfile, h5file, channels, freq, dtype=dtype,
+                    pyramid=True, stats=True, resume=True,
+                    report=open(os.devnull, "w"))
+    d = load_hdf5(h5file)
+    assert np.array_equal(d[:], x)
+    for factor, level in load_pyramid(d):
+        assert np.array_equal(level[:], ref[factor])
+    assert np.array_equal(d.attrs["min"], x.min(axis=0))
+    assert np.allclose(d.attrs["std"], x.std(axis=0))
+    d.file.close()
+    # a resumed conversion must have the same options
+    try:
+        convert_to_hdf5(datfile, h5file, channels, freq, dtype=dtype,
+                        resume=True, report=open(os.devnull, "w"))
+    except ValueError:
+        pass
+    else:
+        assert False, "resumed without the pyramid"
+    try:
+        convert_to_hdf5(datfile, h5file, channels, freq, dtype=dtype,
+                        pyramid=True, resume=True,
+                        report=open(os.devnull, "w"))
+    except ValueError:
+        pass
+    else:
+        assert False, "resumed without the stats"
+    try:
+        convert_to_hdf5(datfile, h5file, channels, 2 * freq, dtype=dtype,
+                        pyramid=True, stats=True, resume=True,
+                        report=open(os.devnull, "w"))
+    except ValueError:
+        pass
+    else:
+        assert False, "resumed with another frequency"
+
+def check_decimation(x, datfile, h5file):
+    d = convert(datfile, h5file, pyramid=True)
+    for cachesize in (0, 2 ** 24):
+        proxy = H5DataProxy(d, cachesize=cachesize)
+        databuffer = (10., 40.)
+        i0, i1 = int(databuffer[0] * freq), int(databuffer[1] * freq)
+        raw = x[i0:i1 + 1]
+        for method in ("m4", "lttb"):
+            xy = proxy.get(databuffer, width=100, decimation=method)
+            indices, y = decimate(raw, 100, method)
+            assert np.array_equal(xy[:, 1], y.T.ravel())
+            assert np.allclose(xy[:, 0], databuffer[0] + indices.T.ravel() /
+                               freq)
+            if method == "m4":
+                # M4 keeps the extrema of every column
+                assert np.array_equal(y.min(axis=0), raw.min(axis=0))
+                assert np.array_equal(y.max(axis=0), raw.max(axis=0))
+        # one sample every step samples
+        y, (x0, dx) = proxy.get_yonly(databuffer, step=7)
+        assert np.array_equal(y.reshape((channels, -1)), raw[::7].T)
+        assert np.allclose(dx, 7. / freq)
+        # channel subsets, whose blocks only hold these channels
+        for subset, sel in (([0, 2], [0, 2]), ((1, 3), [1, 2])):
+            for step in (None, 7):
+                y = proxy.get_y(databuffer, channels=subset, step=step)
+                assert np.array_equal(y, raw[::step, sel])
+        if proxy.cache is not None:
+            assert all(block.shape[1] == len(key[3])
+                       for key, block in proxy.cache.blocks.items())
+        # whole min/max pairs of a level, every step pairs merged
+        proxy = H5DataProxy(d, minrows=200, cachesize=cachesize)
+        source, levelfreq = proxy.select_level(databuffer)
+        assert source is not d and proxy.freq == freq
+        j0, j1 = int(databuffer[0] * levelfreq), int(databuffer[1] * levelfreq)
+        pairs = source[2 * (j0 // 2):2 * (j1 // 2) + 2]
+        for step in (None, 3):
+            y, (x0, dx) = proxy.get_yonly(databuffer, step=step)
+            y = y.reshape((channels, -1)).T
+            ymin, ymax = minmax_decimate(pairs[0::2], pairs[1::2], step or 1)
+            assert np.array_equal(y[0::2], ymin)
+            assert np.array_equal(y[1::2], ymax)
+            assert (y[0::2] <= y[1::2]).all()
+            # the min of the pair q at the start of its block of level rows,
+            # the max half a block later, like the rows of a level
+            rows = 2 * (j0 // 2) + 2 * (step or 1) * np.arange(len(y) // 2)
+            xs = x0 + dx * np.arange(len(y))
+            assert np.allclose(xs[0::2], rows / levelfreq)
+            assert np.allclose(xs[1::2], (rows + (step or 1)) / levelfreq)
+            xy = proxy.get(databuffer, step=step)
+            assert np.allclose(xy[:len(y), 0], xs)
+            assert np.array_equal(xy[:, 1], y.T.ravel())
+    d.file.close()
+
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    try:
+        datfile = os.path.join(tmpdir, "check.dat")
+        h5file = os.path.join(tmpdir, "check.h5")
+        x = create_dat(datfile)
+        for check in (check_rawdata, check_pyramid, check_stats,
+                      check_autotune, check_index,
+                      check_resume, check_decimation):
+            check(x, datfile, h5file)
+            print "%s: ok" % check.__name__
+    finally:
+        shutil.rmtree(tmpdir)
@@ -1,8 +1,10 @@
+import numpy as np
 from PyQt4 import QtCore, QtGui, QtOpenGL
 try:
     from OpenGL import *
     from OpenGL.GL import *
     from OpenGL.GLU import *
+    from OpenGL.GL import shaders
     from PyQt4.QtOpenGL import *
 except ImportError:
     app = QtGui.QApplication(sys.argv)
@@ -10,51 +12,138 @@ except ImportError:
             "PyOpenGL must be installed to run this example.")
     sys.exit(1)
 
+DEFAULT_OPTIONS = dict(mode="line", lw=1.0, color=(1., 1., 1.))
+
+def get_style_groups(databounds, options):
+    """
+    Return the list of ((mode, lw), firsts, counts) of the consecutive plots
+    with the same drawing mode and line width, which can be drawn with a
+    single glMultiDrawArrays call. The plots are drawn in their order.
+    """
+    groups = []
+    for i in xrange(len(databounds) - 1):
+        opt = options[i] or DEFAULT_OPTIONS
+        style = (opt["mode"], opt["lw"])
+        if not groups or groups[-1][0] != style:
+            groups.append((style, [], []))
+        groups[-1][1].append(databounds[i])
+        groups[-1][2].append(databounds[i + 1] - databounds[i])
+    return [(style, np.array(firsts, dtype=np.int32),
+             np.array(counts, dtype=np.int32))
+            for style, firsts, counts in groups]
+
+def is_complete(renormalize):
+    # the renormalize argument of load gives all the bounds, so the data
+    # does not need to be scanned
+    return type(renormalize) is tuple and len(renormalize) == 4
+
+def get_plot_colors(options):
+    # RGBA color of each plot, in [0, 1]
+    colors = np.ones((len(options), 4), dtype=np.float32)
+    for i, opt in enumerate(options):
+        color = (opt or DEFAULT_OPTIONS)["color"]
+        colors[i, :len(color)] = color
+    return colors
+
+def set_style(mode, lw):
+    """
+    Set the line width or the point size, and return the OpenGL mode.
+    """
+    if mode == "line":
+        glLineWidth(lw)
+        return GL_LINE_STRIP
+    elif mode == "points":
+        glPointSize(lw)
+        return GL_POINTS
+
 class DataDisplay(object):
     buffer = None
     bgcolor = (0, 0, 0, 0) # RGB 0-255
     tz0 = -10.
+    # draw all the plots with one glMultiDrawArrays call per line style and
+    # per-vertex colors, instead of one glDrawArrays call per plot
+    batched = True
+    colorbuffer = None
+    colorkey = None
+    colorsbound = False
 
     def load(self, data, databounds=None, options=None, renormalize=True):
-        self.data = data
-        if databounds==None:
+        """
+        data is an array of (x, y) vertices, uploaded as it is in data units:
+        the normalization of the bounds to [0, 1] is part of the modelview
+        matrix (see normalize), so the data is not modified and changing the
+        bounds does not need another upload.
+        """
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        if databounds is None:
             databounds = [0, len(data)]
         if options is None:
             options = [None] * (len(databounds)-1)
         self.options = options
         self.databounds = databounds
-        x = self.data[:,0]
-        # -data because the coordinate systems of the screen and the data
-        # are y-reversed
-        y = -self.data[:,1]
-        
-        if renormalize is not False:
-            # renormalization x,y \in [0,1]
-            if type(renormalize) is not tuple:
-                self.xmin, self.xmax, self.ymin, self.ymax = min(x), max(x), min(y), max(y)
-            elif len(renormalize) == 2:
-                self.xmin, self.xmax = renormalize
-                self.ymin, self.ymax = min(y), max(y)
-            elif len(renormalize) == 4:
-                self.xmin, self.xmax, self.ymin, self.ymax = renormalize
-            if self.xmin == self.xmax:
-                self.xmin = self.xmin - .5
-                self.xmax = self.xmax + .5
-            if self.ymin == self.ymax:
-                self.ymin = self.ymin - .5
-                self.ymax = self.ymax + .5
-        self.data[:,0] = (x-self.xmin)/(self.xmax-self.xmin)
-        self.data[:,1] = (y-self.ymin)/(self.ymax-self.ymin)
+        self.groups = get_style_groups(databounds, options)
+        self.update_colors()
+        
+        if is_complete(renormalize):
+            self.update_bounds(None, None, renormalize)
+        elif renormalize is not False:
+            # -data because the coordinate systems of the screen and the data
+            # are y-reversed
+            self.update_bounds(self.data[:,0], -self.data[:,1], renormalize)
+        
+    def update_bounds(self, x, y, renormalize):
+        # renormalization x,y \in [0,1]
+        if type(renormalize) is not tuple:
+            self.xmin, self.xmax, self.ymin, self.ymax = x.min(), x.max(), y.min(), y.max()
+        elif len(renormalize) == 2:
+            self.xmin, self.xmax = renormalize
+            self.ymin, self.ymax = y.min(), y.max()
+        elif len(renormalize) == 4:
+            self.xmin, self.xmax, self.ymin, self.ymax = renormalize
+        if self.xmin == self.xmax:
+            self.xmin = self.xmin - .5
+            self.xmax = self.xmax + .5
+        if self.ymin == self.ymax:
+            self.ymin = self.ymin - .5
+            self.ymax = self.ymax + .5
+        
+    def update_colors(self):
+        """
+        Update the per-vertex colors, RGBA bytes, if the plots have changed.
+        """
+        if not self.batched:
+            return
+        colors = np.array(get_plot_colors(self.options) * 255, dtype=np.uint8)
+        key = (tuple(self.databounds), colors.tostring())
+        if key == self.colorkey:
+            return
+        self.colorkey = key
+        self.colors = np.repeat(colors, np.diff(self.databounds), axis=0)
+        self.colorsbound = False
         
     def get_bounds(self):
         return self.xmin, self.xmax, self.ymin, self.ymax
         
+    def set_bounds(self, xmin, xmax, ymin, ymax):
+        """
+        Change the bounds, without uploading the data again.
+        """
+        self.update_bounds(None, None, (xmin, xmax, ymin, ymax))
+        
     def bind_data_buffer(self):
         glBufferData(GL_ARRAY_BUFFER, self.data, GL_STATIC_DRAW)
+        if self.batched and self.colorbuffer is not None and \
+                not self.colorsbound:
+            glBindBuffer(GL_ARRAY_BUFFER, self.colorbuffer)
+            glBufferData(GL_ARRAY_BUFFER, self.colors, GL_STATIC_DRAW)
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+            self.colorsbound = True
         
     def initialize(self):
         glClearColor(*self.bgcolor)
         glEnableClientState(GL_VERTEX_ARRAY)
+        if self.batched:
+            self.colorbuffer = glGenBuffers(1)
         self.buffer = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
         self.bind_data_buffer()
@@ -64,27 +153,46 @@ class DataDisplay(object):
         glScalef(sx, sy, 1.)
         glTranslatef(tx, ty, self.tz0)
         
+    def normalize(self):
+        """
+        Multiply the modelview matrix by the normalization of the bounds to
+        [0, 1], y-reversed.
+        """
+        glScalef(1. / (self.xmax - self.xmin), -1. / (self.ymax - self.ymin), 1.)
+        glTranslatef(-self.xmin, self.ymin, 0.)
+        
     def paint_single(self, i0, n, options):
         mode = options["mode"] # "line" or "points"
         lw = options["lw"] # size of line or points in pixels
         color = options["color"] # should be a tuple 0-1
-        if mode == "line":
-            glLineWidth(lw)
-            glmode = GL_LINE_STRIP
-        elif mode == "points":
-            glPointSize(lw)
-            glmode = GL_POINTS
+        glmode = set_style(mode, lw)
         glColor(*color)
         glDrawArrays(glmode, i0, n)
         
+    def paint_batched(self):
+        for (mode, lw), firsts, counts in self.groups:
+            glMultiDrawArrays(set_style(mode, lw), firsts, counts, len(firsts))
+        
     def paint(self):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         
         if self.buffer is not None:
-            glVertexPointer(2, GL_FLOAT, 0, None)
-            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
-            for i in xrange(len(self.databounds)-1):
-                self.paint_single(self.databounds[i], self.databounds[i+1] - self.databounds[i], self.options[i])
+            glPushMatrix()
+            self.normalize()
+            if self.batched:
+                glBindBuffer(GL_ARRAY_BUFFER, self.colorbuffer)
+                glEnableClientState(GL_COLOR_ARRAY)
+                glColorPointer(4, GL_UNSIGNED_BYTE, 0, None)
+                glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+                glVertexPointer(2, GL_FLOAT, 0, None)
+                self.paint_batched()
+                glDisableClientState(GL_COLOR_ARRAY)
+            else:
+                glVertexPointer(2, GL_FLOAT, 0, None)
+                glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+                for i in xrange(len(self.databounds)-1):
+                    self.paint_single(self.databounds[i], self.databounds[i+1] - self.databounds[i], self.options[i])
+            glPopMatrix()
             glFlush()
         
     def resize(self, w, h):
@@ -95,3 +203,339 @@ class DataDisplay(object):
         glOrtho(-0.5, +0.5, +0.5, -0.5, 4.0, 15.0)
         glMatrixMode(GL_MODELVIEW)
 
+
+YVERTEX_SHADER = """
+#version 130
+#define MAXSLOTS 16
+in float y;  // raw value, converted to float if it is an integer
+// the vertex buffer is made of slots of slotrows samples of each channel,
+// channel after channel
+uniform int slotrows;
+uniform int nchannels;
+uniform float slotx0[MAXSLOTS];  // normalized x of the first sample of a slot
+uniform float dx;  // normalized x step between two samples
+// two texels per channel: (gain, offset, 0, 0), where the normalized y is
+// gain * y + offset, and the color
+uniform sampler1D channels;
+void main()
+{
+    int i = gl_VertexID % slotrows;
+    int channel = (gl_VertexID / slotrows) % nchannels;
+    int slot = gl_VertexID / (slotrows * nchannels);
+    vec4 transform = texelFetch(channels, 2 * channel, 0);
+    float x = slotx0[slot] + float(i) * dx;
+    gl_Position = gl_ModelViewProjectionMatrix *
+        vec4(x, transform.x * y + transform.y, 0., 1.);
+    gl_FrontColor = texelFetch(channels, 2 * channel + 1, 0);
+}
+"""
+
+# maximum number of slots of the vertex buffer, see YVERTEX_SHADER
+MAXSLOTS = 16
+
+YFRAGMENT_SHADER = """
+#version 130
+void main()
+{
+    gl_FragColor = gl_Color;
+}
+"""
+
+# OpenGL types of the y values which can be uploaded as they are
+GL_TYPES = {
+    np.dtype(np.float32): GL_FLOAT,
+    np.dtype(np.int16): GL_SHORT,
+    np.dtype(np.uint16): GL_UNSIGNED_SHORT,
+    np.dtype(np.int8): GL_BYTE,
+    }
+
+def get_slot_groups(nchannels, slotrows, slots, options):
+    """
+    Return the list of ((mode, lw), firsts, counts) of the line strips of
+    consecutive channels with the same style, in a vertex buffer made of
+    slots of slotrows samples of each channel. slots is the list of
+    (slot, x0, rows) to draw. The channels are drawn in their order.
+    """
+    groups = []
+    for c in xrange(nchannels):
+        opt = options[c] or DEFAULT_OPTIONS
+        style = (opt["mode"], opt["lw"])
+        if not groups or groups[-1][0] != style:
+            groups.append((style, [], []))
+        for slot, x0, rows in slots:
+            if rows > 0:
+                groups[-1][1].append((slot * nchannels + c) * slotrows)
+                groups[-1][2].append(rows)
+    return [(style, np.array(firsts, dtype=np.int32),
+             np.array(counts, dtype=np.int32))
+            for style, firsts, counts in groups]
+
+class YDataDisplay(DataDisplay):
+    """
+    Display y-only data: the y values of all channels, channel after channel,
+    all channels having the same number of samples. The x values are
+    computed in the vertex shader from the vertex index, which halves the
+    size of the vertex buffer.
+    The y values are uploaded as they are, float32 or integers such as raw
+    int16 samples, and are scaled in the vertex shader with a gain and an
+    offset per channel, so that the data is neither converted nor modified.
+    The gains, offsets and colors of the channels are read by the shader in
+    a small 1D texture, so that all channels can be drawn at once.
+    The vertex buffer is a single slot of slotrows samples per channel, see
+    CircularYDataDisplay for several slots.
+    """
+    program = None
+    texture = None
+    texelkey = None
+    # offset of the x values of the slots, for the subclasses which keep the
+    # data of older data buffers
+    offsetx = 0.
+    
+    def load(self, data, databounds=None, options=None, renormalize=True,
+             x=(0., 1.), gains=None, offsets=None):
+        """
+        x = (x0, dx): the x value of the sample i of each channel is
+        x0 + i * dx.
+        gains and offsets convert the values of each channel into physical
+        values, gain * y + offset, by default 1 and 0. The bounds are given
+        in physical values.
+        """
+        data = np.asarray(data)
+        if data.dtype not in GL_TYPES:
+            data = np.array(data, dtype=np.float32)
+        self.data = data
+        if databounds is None:
+            databounds = [0, len(data)]
+        if options is None:
+            options = [None] * (len(databounds)-1)
+        self.options = options
+        self.databounds = databounds
+        self.nchannels = len(databounds) - 1
+        self.nsamples = databounds[1] - databounds[0]
+        self.slotrows = max(self.nsamples, 1)
+        self.x0, self.dx = x
+        self.slots = [(0, self.x0, self.nsamples)]
+        self.set_gains(gains, offsets)
+        self.groups = get_slot_groups(self.nchannels, self.slotrows,
+                                      self.slots, options)
+        
+        if is_complete(renormalize):
+            self.update_bounds(None, None, renormalize)
+        elif renormalize is not False:
+            y = data[:self.nchannels * self.nsamples].reshape(
+                (self.nchannels, -1))
+            if y.size:
+                ymins, ymaxs = y.min(axis=1), y.max(axis=1)
+            else:
+                ymins = ymaxs = np.zeros(1)
+            self.update_channel_bounds(ymins, ymaxs, renormalize)
+        
+    def set_gains(self, gains=None, offsets=None):
+        if gains is None:
+            gains = np.ones(self.nchannels)
+        if offsets is None:
+            offsets = np.zeros(self.nchannels)
+        self.gains = np.asarray(gains, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.float64)
+        
+    def update_channel_bounds(self, ymins, ymaxs, renormalize):
+        """
+        Update the bounds from the raw min and max values of each channel,
+        and the x range of the slots.
+        """
+        x0 = min(x0 for slot, x0, rows in self.slots)
+        x1 = max(x0 + (rows - 1) * self.dx for slot, x0, rows in self.slots)
+        x = np.array([x0, x1]) - self.offsetx
+        # physical range of each channel
+        y0 = ymins * self.gains + self.offsets
+        y1 = ymaxs * self.gains + self.offsets
+        # -y because the coordinate systems of the screen and the data
+        # are y-reversed
+        y = -np.hstack((y0, y1))
+        self.update_bounds(x, y, renormalize)
+        
+    def get_channel_transform(self, i):
+        """
+        Return the (gain, offset) which transforms the values of the channel
+        i, or of an array of channels, into normalized, y-reversed values.
+        """
+        scale = 1. / (self.ymax - self.ymin)
+        gain = -self.gains[i] * scale
+        offset = (-self.offsets[i] - self.ymin) * scale
+        return gain, offset
+        
+    def get_channel_texels(self):
+        """
+        Return the texels of the channel texture: (gain, offset, 0, 0) and
+        the RGBA color of each channel.
+        """
+        texels = np.zeros((self.nchannels, 2, 4), dtype=np.float32)
+        gains, offsets = self.get_channel_transform(np.arange(self.nchannels))
+        texels[:, 0, 0] = gains
+        texels[:, 0, 1] = offsets
+        texels[:, 1] = get_plot_colors(self.options)
+        return texels.reshape((-1, 4))
+        
+    def get_slot_x0(self):
+        # normalized x of the first sample of each slot
+        slotx0 = np.zeros(MAXSLOTS, dtype=np.float32)
+        scale = 1. / (self.xmax - self.xmin)
+        for slot, x0, rows in self.slots:
+            slotx0[slot] = (x0 - self.offsetx - self.xmin) * scale
+        return slotx0
+        
+    def bind_channel_texture(self):
+        """
+        Bind the channel texture, and upload the texels if the gains, offsets,
+        bounds or colors have changed since the last upload.
+        """
+        glBindTexture(GL_TEXTURE_1D, self.texture)
+        texels = self.get_channel_texels()
+        key = texels.tostring()
+        if key == self.texelkey:
+            return
+        self.texelkey = key
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexImage1D(GL_TEXTURE_1D, 0, GL_RGBA32F, len(texels), 0, GL_RGBA,
+                     GL_FLOAT, texels)
+        
+    def initialize(self):
+        glClearColor(*self.bgcolor)
+        self.program = shaders.compileProgram(
+            shaders.compileShader(YVERTEX_SHADER, GL_VERTEX_SHADER),
+            shaders.compileShader(YFRAGMENT_SHADER, GL_FRAGMENT_SHADER))
+        self.yloc = glGetAttribLocation(self.program, "y")
+        self.texture = glGenTextures(1)
+        self.texelkey = None
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        self.bind_data_buffer()
+        
+    def paint(self):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        
+        if self.buffer is not None:
+            glUseProgram(self.program)
+            # normalized x of the samples
+            glUniform1fv(glGetUniformLocation(self.program, "slotx0"),
+                         MAXSLOTS, self.get_slot_x0())
+            glUniform1f(glGetUniformLocation(self.program, "dx"),
+                        self.dx / (self.xmax - self.xmin))
+            glUniform1i(glGetUniformLocation(self.program, "slotrows"),
+                        self.slotrows)
+            glUniform1i(glGetUniformLocation(self.program, "nchannels"),
+                        max(self.nchannels, 1))
+            glActiveTexture(GL_TEXTURE0)
+            self.bind_channel_texture()
+            glUniform1i(glGetUniformLocation(self.program, "channels"), 0)
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+            glEnableVertexAttribArray(self.yloc)
+            glVertexAttribPointer(self.yloc, 1, GL_TYPES[self.data.dtype],
+                                  GL_FALSE, 0, None)
+            if self.batched:
+                self.paint_batched()
+            else:
+                for (mode, lw), firsts, counts in self.groups:
+                    glmode = set_style(mode, lw)
+                    for first, count in zip(firsts, counts):
+                        glDrawArrays(glmode, first, count)
+            glDisableVertexAttribArray(self.yloc)
+            glBindTexture(GL_TEXTURE_1D, 0)
+            glUseProgram(0)
+            glFlush()
+
+
+class CircularYDataDisplay(YDataDisplay):
+    """
+    YDataDisplay whose vertex buffer is a circular window of nslots slots.
+    Each slot holds one viewport of every channel, plus the first sample of
+    the next viewport so that the line strips of consecutive slots join.
+    When the data buffer shifts, only the slots of the newly exposed
+    viewports are uploaded with glBufferSubData, and the x of their first
+    sample is a uniform of the vertex shader, so the upload cost of a pan is
+    proportional to the distance moved.
+    """
+    allocated = False
+    
+    def allocate(self, nchannels, nslots, slotrows, dtype, options=None,
+                 gains=None, offsets=None):
+        """
+        Prepare an empty vertex buffer of nslots slots of slotrows samples
+        of each channel.
+        """
+        if nslots > MAXSLOTS:
+            raise ValueError("At most %d slots" % MAXSLOTS)
+        self.nchannels = nchannels
+        self.nslots = nslots
+        self.slotrows = max(slotrows, 1)
+        dtype = np.dtype(dtype)
+        if dtype not in GL_TYPES:
+            dtype = np.dtype(np.float32)
+        # only the dtype and size are used, see bind_data_buffer
+        self.data = np.zeros(0, dtype=dtype)
+        if options is None:
+            options = [None] * nchannels
+        self.options = options
+        self.set_gains(gains, offsets)
+        self.slots = []
+        self.groups = []
+        self.pending = {}  # slot: y values to upload
+        self.ranges = {}  # slot: raw min and max of each channel
+        self.allocated = False
+        
+    def set_slot(self, slot, y, x0, dx, scan=True):
+        """
+        Put the y values of all the channels, an array (nchannels, rows)
+        with rows <= slotrows, in a slot. The x value of the sample i is
+        x0 + i * dx. If scan is True, the range of each channel is kept for
+        update_slot_bounds.
+        """
+        y = np.asarray(y)
+        nchannels, rows = y.shape
+        data = np.zeros((self.nchannels, self.slotrows), dtype=self.data.dtype)
+        data[:, :rows] = y
+        self.pending[slot] = data
+        self.dx = dx
+        if rows and scan:
+            self.ranges[slot] = (y.min(axis=1), y.max(axis=1))
+        else:
+            self.ranges.pop(slot, None)
+        return rows
+        
+    def set_slots(self, slots):
+        """
+        slots is the list of (slot, x0, rows) to draw.
+        """
+        self.slots = slots
+        self.groups = get_slot_groups(self.nchannels, self.slotrows, slots,
+                                      self.options)
+        
+    def update_slot_bounds(self, renormalize):
+        # bounds from the raw range of the drawn slots
+        if is_complete(renormalize):
+            self.update_bounds(None, None, renormalize)
+            return
+        ranges = [self.ranges[slot] for slot, x0, rows in self.slots
+                  if slot in self.ranges]
+        if ranges:
+            ymins = np.min([r[0] for r in ranges], axis=0)
+            ymaxs = np.max([r[1] for r in ranges], axis=0)
+        else:
+            ymins = ymaxs = np.zeros(1)
+        self.update_channel_bounds(ymins, ymaxs, renormalize)
+        
+    def bind_data_buffer(self):
+        if not self.allocated:
+            nbytes = self.nslots * self.nchannels * self.slotrows * \
+                     self.data.dtype.itemsize
+            glBufferData(GL_ARRAY_BUFFER, nbytes, None, GL_DYNAMIC_DRAW)
+            self.allocated = True
+        for slot, data in self.pending.iteritems():
+            glBufferSubData(GL_ARRAY_BUFFER, slot * data.nbytes, data.nbytes,
+                            data)
+        self.pending.clear()
+        
+    def initialize(self):
+        self.allocated = False
+        super(CircularYDataDisplay, self).initialize()
@@ -1,7 +1,35 @@
+import mmap
 import numpy as np
-from h5 import read_hdf5
+from blockcache import BlockCache, get_file_key
+from decimation import decimate
+from h5 import select_level, get_channel_selection, get_totalrows, \
+    is_swmr, get_selection_size, load_minmax_index
+
+class BufferPool(object):
+    """
+    Preallocated buffers, float32 by default, used in turn. The arrays
+    returned by get are views on them, which stay valid until the pool has
+    been cycled through ``count`` times.
+    """
+    def __init__(self, size=0, count=2, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.buffers = [np.empty(size, dtype=self.dtype) for _ in xrange(count)]
+        self.index = 0
+        
+    def get(self, shape):
+        size = int(np.prod(shape))
+        buffer = self.buffers[self.index]
+        if buffer.size < size:
+            # only happens when a larger window than expected is requested
+            buffer = np.empty(size, dtype=self.dtype)
+            self.buffers[self.index] = buffer
+        self.index = (self.index + 1) % len(self.buffers)
+        return buffer[:size].reshape(shape)
 
 class DataProxy(object):
+    # optional paralleldecimation.ParallelDecimator used by decimate
+    decimator = None
+    
     def __init__(self, data, freq):
         self.fulldata = data
         self.data = None  # current data
@@ -10,64 +38,470 @@ class DataProxy(object):
         self.channels = data.shape[1]
         self.duration = (data.shape[0] - 1) / float(freq)
         
-    def get_indices(self, databuffer):
+    def refresh(self):
+        """
+        Check whether new samples have been appended to the data since the
+        last call, and update the duration. Return True if so.
+        """
+        return False
+        
+    def prefetch(self, databuffer, channels=None, step=None):
+        """
+        Load a data buffer ahead of time, so that a later get of the same
+        data buffer does not wait for it. Called from a worker thread.
+        The data of this proxy is already in memory.
+        """
+        pass
+        
+    def get_yrange(self, channels=None, databuffer=None):
+        """
+        Return the (min, max) of the given channels over the data buffer, or
+        over the whole data if databuffer is None, if it is known without
+        reading the data, or None. The range may be larger than the exact
+        one.
+        """
+        return None
+        
+    def get_nrows(self):
+        return self.fulldata.shape[0]
+        
+    def get_indices(self, databuffer, freq=None):
+        # rows at the given frequency, by default the one of the data
+        if freq is None:
+            freq = self.freq
         x0, x1 = databuffer
-        i0 = int(np.round(x0 * self.freq))
-        i1 = int(np.round(x1 * self.freq))
+        i0 = int(np.round(x0 * freq))
+        i1 = int(np.round(x1 * freq))
         return i0, i1
         
-    def get_x(self, databuffer, offsetx=None):
+    def get_x(self, databuffer, offsetx=None, step=None):
         if offsetx is None:
             offsetx = 0.0
         x0, x1 = databuffer
         i0, i1 = self.get_indices(databuffer)
         n = i1 - i0 + 1
-        x = np.linspace(x0 - offsetx, x1 - offsetx, n)
+        # no x beyond the end of the data
+        nrows = max(self.get_nrows() - i0, 0)
+        x = np.linspace(x0 - offsetx, x1 - offsetx, n)[:nrows][::step]
         return x
         
-    def get_y(self, databuffer):
+    def get_dx(self, databuffer, step=None, freq=None):
+        """
+        Return the x step between two returned samples, of rows at the given
+        frequency.
+        """
+        x0, x1 = databuffer
+        i0, i1 = self.get_indices(databuffer, freq)
+        if i1 <= i0:
+            return 0.
+        return (step or 1) * (x1 - x0) / (i1 - i0)
+        
+    def get_y(self, databuffer, channels=None, step=None):
         """
         Return an array N x channels
         """
         x0, x1 = databuffer
         i0, i1 = self.get_indices(databuffer)
-        arr = self.fulldata[i0:i1 + 1,:]
+        arr = self.fulldata[i0:i1 + 1:step, get_channel_selection(channels)]
         return arr
         
-    def get(self, databuffer, offsetx=None):
+    def get(self, databuffer, offsetx=None, channels=None, step=None,
+            width=None, decimation="m4"):
         """
         Return the data corresponding to the interval databuffer = (x0, x1),
         this interval should contain the current 1s viewport, plus the
         previous and next viewports.
+        Only the given channels (see h5.get_channel_selection) and one sample
+        every ``step`` samples are returned.
+        If width is not None, the data is decimated to the given number of
+        pixel columns with the given decimation method, "m4" or "lttb", see
+        decimate.
         """
-        # determine x
-        x = self.get_x(databuffer, offsetx=offsetx)
-        
         # determine y
-        arr = self.get_y(databuffer)
+        arr = self.get_y(databuffer, channels=channels, step=step)
         self.arr = arr
+        if width is not None and arr.shape[0] > 4 * width:
+            return self.decimate(databuffer, offsetx, arr, width, step=step,
+                                 method=decimation)
+        
+        # determine x
+        x = self.get_x(databuffer, offsetx=offsetx, step=step)
         
         # concatenate x and y and generate self.data
         x = x.reshape((-1,1))
-        x = np.tile(x, (self.channels, 1))
+        x = np.tile(x, (arr.shape[1], 1))
         
         y = arr.flatten('F')
         y = y.reshape((-1,1))
         
         self.data = np.array(np.hstack((np.array(x), np.array(y))), np.float32)
         return self.data
+        
+    def get_xy_buffer(self, shape):
+        return np.empty(shape, dtype=np.float32)
+        
+    def decimate(self, databuffer, offsetx, arr, width, step=None,
+                 method="m4", freq=None, x=None):
+        """
+        Return the (x, y) vertices of arr, the N x channels array of the
+        data buffer, decimated for width pixel columns: with "m4", the
+        first, min, max and last samples of each column and channel, with
+        "lttb", the Largest-Triangle-Three-Buckets downsampling.
+        x = (x0, dx) is the x of the row i of arr, x0 + i * dx, by default
+        from the data buffer.
+        """
+        if offsetx is None:
+            offsetx = 0.0
+        if x is None:
+            x = (databuffer[0], self.get_dx(databuffer, step=step, freq=freq))
+        if self.decimator is not None:
+            indices, y = self.decimator.decimate(arr, width, method)
+        else:
+            indices, y = decimate(arr, width, method)
+        n, nchannels = y.shape
+        out = self.get_xy_buffer((n * nchannels, 2))
+        xy = out.reshape((nchannels, n, 2))
+        xy[:, :, 1] = y.T
+        x0, dx = x
+        x = xy[:, :, 0]
+        x[...] = indices.T
+        x *= dx
+        x += x0 - offsetx
+        self.data = out
+        return out
+        
+    def get_yonly(self, databuffer, offsetx=None, channels=None, step=None,
+                  dtype=np.float32):
+        """
+        Like get, but return (y, (x0, dx)) where y only contains the y values,
+        channel after channel, in a contiguous 1D array of the given dtype.
+        The x value of the sample i of each channel is x0 + i * dx.
+        """
+        if offsetx is None:
+            offsetx = 0.0
+        arr = self.get_y(databuffer, channels=channels, step=step)
+        self.arr = arr
+        y = np.empty((arr.shape[1], arr.shape[0]), dtype=dtype)
+        y[...] = arr.T
+        self.data = y.ravel()
+        return self.data, (databuffer[0] - offsetx,
+                           self.get_dx(databuffer, step=step))
 
         
 class H5DataProxy(DataProxy):
-    def __init__(self, h5data):
+    def __init__(self, h5data, minrows=None, buffersize=3.0, nbuffers=2,
+                 cachesize=256 * 2 ** 20, blockdur=.5, cache=None):
+        """
+        If minrows is not None, the data is read from the coarsest min/max
+        level of the file that still has at least minrows rows in the
+        requested data buffer.
+        The data is read into preallocated buffers sized for data buffers of
+        ``buffersize`` seconds. The array returned by get is valid until
+        get has been called ``nbuffers`` more times.
+        The data is read by blocks of ``blockdur`` seconds, which are kept in
+        a BlockCache of ``cachesize`` bytes, keyed by (file, level, block
+        index, channels), each block holding the requested channels only, so
+        that the reads and the cache grow with the visible channels. Use
+        cachesize=0 to read the data directly.
+        cache can be a cache shared by several proxies instead, a BlockCache
+        in the same process, or a SharedBlockCache across processes.
+        """
         self.h5data = h5data
+        self.minrows = minrows
         self.data = None
+        self.arr = None
         self.freq = h5data.attrs["freq"]
         self.channels = h5data.attrs["channels"]
         self.duration = h5data.attrs["duration"]
+        rows = int(np.ceil(buffersize * self.freq)) + 2
+        self.buffersize = rows * self.channels
+        self.nbuffers = nbuffers
+        self.pools = {}
+        self.ramp = np.arange(rows, dtype=np.float32)
+        self.blockdur = blockdur
+        self.filekey = get_file_key(h5data.file.filename)
+        self.index = load_minmax_index(h5data)
+        if cache is not None:
+            self.cache = cache
+        elif cachesize:
+            self.cache = BlockCache(cachesize)
+        else:
+            self.cache = None
+        
+    def get_buffer(self, name, shape, dtype=np.float32):
+        """
+        Return a preallocated array from the pool with the given name and
+        dtype. The "read" pool has a single buffer, used for reading the
+        data from the file, the other pools have nbuffers buffers.
+        """
+        dtype = np.dtype(dtype)
+        if (name, dtype) not in self.pools:
+            if name == "read":
+                pool = BufferPool(self.buffersize, 1, dtype)
+            else:
+                pool = BufferPool(2 * self.buffersize, self.nbuffers, dtype)
+            self.pools[name, dtype] = pool
+        return self.pools[name, dtype].get(shape)
+        
+    def get_xy_buffer(self, shape):
+        return self.get_buffer("xy", shape)
         
-    def get_y(self, databuffer):
+    def select_level(self, databuffer):
+        """
+        Return the (source, freq) of a data buffer: RawData, or the coarsest
+        min/max level with at least minrows rows in it, and the frequency of
+        its rows.
+        """
         x0, x1 = databuffer
-        arr = read_hdf5(self.h5data, x0, x1 - x0)
+        source = select_level(self.h5data, x0, x1 - x0, self.minrows)
+        return source, source.attrs["freq"]
+        
+    def read(self, databuffer, channels=None, step=None, dtype=np.float32,
+             source=None):
+        """
+        Read the y values of source, by default RawData, into a preallocated
+        N x channels array of the given dtype, HDF5 converting the values if
+        needed. The rows of a min/max level alternate the min and the max,
+        so whole (min, max) pairs are read, and every step pairs are merged
+        into one, see read_pairs.
+        """
+        if source is None:
+            source = self.h5data
+        freq = source.attrs["freq"]
+        i0, i1 = self.get_indices(databuffer, freq)
+        # no row beyond the end of the data
+        i1 = min(i1, source.shape[0] - 1)
+        sel = get_channel_selection(channels)
+        nchannels = get_selection_size(sel, self.channels)
+        if source is not self.h5data:
+            return self.read_pairs(source, i0, i1, step, sel, nchannels, dtype)
+        n = len(xrange(i0, i1 + 1, step or 1))
+        arr = self.get_buffer("read", (n, nchannels), dtype)
+        if n > 0 and nchannels > 0:
+            self.read_rows(source, arr, i0, i1, step or 1, sel)
+        self.arr = arr
         return arr
-        
\ No newline at end of file
+        
+    def read_pairs(self, source, i0, i1, step, sel, nchannels, dtype):
+        """
+        Read the whole (min, max) pairs of the level rows i0 to i1, from the
+        pair of the row i0, and merge every step pairs into the min of their
+        mins and the max of their maxes, which is the pair of a level with a
+        step times larger factor. The pair q then starts at the level row
+        2 * (i0 // 2 + q * step), see get_source_x.
+        """
+        step = step or 1
+        p0 = i0 // 2
+        p1 = min(i1 // 2, source.shape[0] // 2 - 1)
+        npairs = max(p1 - p0 + 1, 0)
+        n = 2 * len(xrange(0, npairs, step))
+        arr = self.get_buffer("read", (n, nchannels), dtype)
+        if n > 0 and nchannels > 0:
+            if step == 1:
+                self.read_rows(source, arr, 2 * p0, 2 * p1 + 1, 1, sel)
+            else:
+                rows = self.get_buffer("pairs", (2 * npairs, nchannels), dtype)
+                self.read_rows(source, rows, 2 * p0, 2 * p1 + 1, 1, sel)
+                groups = np.arange(0, npairs, step)
+                arr[0::2] = np.minimum.reduceat(rows[0::2], groups, axis=0)
+                arr[1::2] = np.maximum.reduceat(rows[1::2], groups, axis=0)
+        self.arr = arr
+        return arr
+        
+    def get_source_x(self, databuffer, source, freq, step=None):
+        """
+        Return the (x0, dx) of the rows returned by read: the x of the row i
+        is x0 + i * dx. The rows of a min/max level start at its first whole
+        pair, and the min and max of a pair are half a pair apart, like the
+        rows of a level.
+        """
+        if source is self.h5data:
+            return databuffer[0], self.get_dx(databuffer, step=step, freq=freq)
+        i0, i1 = self.get_indices(databuffer, freq)
+        return 2 * (i0 // 2) / freq, (step or 1) / freq
+        
+    def read_rows(self, source, arr, i0, i1, step, sel):
+        # fill arr with the rows i0:i1+1:step of the selected channels
+        if self.cache is None:
+            source.read_direct(arr, source_sel=np.s_[i0:i1 + 1:step, sel])
+        else:
+            self.read_blocks(source, arr, i0, i1, step, sel)
+        
+    def get_blockrows(self, freq):
+        return max(1, int(round(self.blockdur * freq)))
+        
+    def get_block_key(self, source, block, sel):
+        # the selected channels, whatever the form of the selection
+        if isinstance(sel, slice):
+            sel = xrange(*sel.indices(self.channels))
+        return (self.filekey, source.name, block, tuple(sel))
+        
+    def read_blocks(self, source, arr, i0, i1, step, sel):
+        """
+        Fill arr with the rows i0:i1+1:step of the selected channels, from
+        the cached blocks, reading the missing ones from the file.
+        """
+        blockrows = self.get_blockrows(source.attrs["freq"])
+        for block in xrange(i0 // blockrows, i1 // blockrows + 1):
+            b0 = block * blockrows
+            data = self.get_block(source, blockrows, block, sel)
+            b1 = b0 + data.shape[0]
+            # first row of the block which is a multiple of step from i0
+            r0 = max(i0, b0)
+            r0 += (i0 - r0) % step
+            r1 = min(i1 + 1, b1)
+            if r0 >= r1:
+                continue
+            k0 = (r0 - i0) // step
+            k1 = k0 + len(xrange(r0, r1, step))
+            arr[k0:k1] = data[r0 - b0:r1 - b0:step]
+        
+    def get_block(self, source, blockrows, block, sel):
+        """
+        Return the rows of a block of source, for the selected channels,
+        from the cache, or read from source if it is not cached.
+        """
+        data = self.cache.get(self.get_block_key(source, block, sel))
+        if data is None:
+            data = self.read_block(source, blockrows, block, sel)
+        return data
+        
+    def read_block(self, source, blockrows, block, sel):
+        # a single read of the selected channels
+        b0 = block * blockrows
+        b1 = min(b0 + blockrows, source.shape[0])
+        data = source[b0:b1, sel]
+        # the last block may still grow in a SWMR file
+        if b1 - b0 == blockrows:
+            self.cache.put(self.get_block_key(source, block, sel), data)
+        return data
+        
+    def prefetch(self, databuffer, channels=None, step=None):
+        # fill the cache only, without touching the state used by get
+        if self.cache is None:
+            return
+        source, freq = self.select_level(databuffer)
+        blockrows = self.get_blockrows(freq)
+        i0, i1 = self.get_indices(databuffer, freq)
+        i1 = min(i1, source.shape[0] - 1)
+        if i1 < i0:
+            return
+        sel = get_channel_selection(channels)
+        # not counted in the hits and misses of the cache, which are those of
+        # the reads
+        for block in xrange(i0 // blockrows, i1 // blockrows + 1):
+            if self.get_block_key(source, block, sel) not in self.cache:
+                self.read_block(source, blockrows, block, sel)
+        
+    def get(self, databuffer, offsetx=None, channels=None, step=None,
+            width=None, decimation="m4"):
+        source, freq = self.select_level(databuffer)
+        if offsetx is None:
+            offsetx = 0.0
+        x0, dx = self.get_source_x(databuffer, source, freq, step=step)
+        arr = self.read(databuffer, channels=channels, step=step,
+                        source=source)
+        n, nchannels = arr.shape
+        if width is not None and n > 4 * width:
+            return self.decimate(databuffer, offsetx, arr, width, step=step,
+                                 method=decimation, x=(x0, dx))
+        
+        # fill the (x, y) buffer, channel after channel, in place
+        data = self.get_xy_buffer((n * nchannels, 2))
+        xy = data.reshape((nchannels, n, 2))
+        xy[:, :, 1] = arr.T
+        if len(self.ramp) < n:
+            self.ramp = np.arange(n, dtype=np.float32)
+        x = xy[:, :, 0]
+        x[...] = self.ramp[:n]
+        x *= dx
+        x += x0 - offsetx
+        self.data = data
+        return data
+        
+    def get_yonly(self, databuffer, offsetx=None, channels=None, step=None,
+                  dtype=np.float32):
+        source, freq = self.select_level(databuffer)
+        if offsetx is None:
+            offsetx = 0.0
+        arr = self.read(databuffer, channels=channels, step=step, dtype=dtype,
+                        source=source)
+        n, nchannels = arr.shape
+        y = self.get_buffer("y", (nchannels, n), dtype)
+        y[...] = arr.T
+        self.data = y.ravel()
+        x0, dx = self.get_source_x(databuffer, source, freq, step=step)
+        return self.data, (x0 - offsetx, dx)
+        
+    def get_nrows(self):
+        return self.h5data.shape[0]
+        
+    def get_yrange(self, channels=None, databuffer=None):
+        # min/max index saved by convert_to_hdf5(..., index=True)
+        if databuffer is not None and self.index is not None:
+            x0, x1 = databuffer
+            freq = self.h5data.attrs["freq"]
+            yrange = self.index.query(int(np.round(x0 * freq)),
+                                      int(np.round(x1 * freq)), channels)
+            if yrange is not None:
+                return yrange[0].min(), yrange[1].max()
+        # statistics saved by convert_to_hdf5(..., stats=True)
+        attrs = self.h5data.attrs
+        if "min" not in attrs or "max" not in attrs:
+            return None
+        sel = get_channel_selection(channels)
+        return attrs["min"][sel].min(), attrs["max"][sel].max()
+        
+    def refresh(self):
+        # only a file opened in SWMR mode sees the rows appended by a writer
+        if not is_swmr(self.h5data):
+            return False
+        self.h5data.refresh()
+        rows = self.h5data.shape[0]
+        duration = (rows - 1) / float(self.h5data.attrs["freq"])
+        if duration <= self.duration:
+            return False
+        self.duration = duration
+        return True
+        
+    def get_y(self, databuffer, channels=None, step=None):
+        # the returned array is overwritten by the next read
+        return self.read(databuffer, channels=channels, step=step,
+                         dtype=self.h5data.dtype)
+
+
+class MemmapDataProxy(DataProxy):
+    def __init__(self, filename, channels, freq, dtype=None):
+        """
+        Proxy to a binary array file in the format of neuroscope, mapped in
+        memory with np.memmap, so that nothing is read before it is needed.
+        By default, dtype is int16.
+        """
+        if dtype is None:
+            dtype = np.dtype(np.int16)
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        super(MemmapDataProxy, self).__init__(self.map(channels), freq)
+        
+    def map(self, channels):
+        rows = get_totalrows(self.filename, channels, self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode="r",
+                         shape=(rows, channels))
+        
+    def prefetch(self, databuffer, channels=None, step=None):
+        # touch one value per page to get the pages into the page cache
+        data = self.fulldata
+        i0, i1 = self.get_indices(databuffer)
+        i1 = min(i1, data.shape[0] - 1)
+        rowsperpage = max(1, mmap.PAGESIZE // (self.channels * self.dtype.itemsize))
+        if i1 >= i0:
+            data[i0:i1 + 1:rowsperpage, 0].sum()
+        
+    def refresh(self):
+        rows = get_totalrows(self.filename, self.channels, self.dtype)
+        if rows <= self.fulldata.shape[0]:
+            return False
+        # mapping the file again does not read anything
+        self.fulldata = self.map(self.channels)
+        self.duration = (rows - 1) / float(self.freq)
+        return True
@@ -0,0 +1,131 @@
+import numpy as np
+
+def get_m4_columns(n, width):
+    """
+    Return (binsize, columns): the number of rows per column and the number
+    of columns of the M4 aggregation of n rows over width pixel columns.
+    """
+    binsize = int(np.ceil(n / float(width)))
+    return binsize, int(np.ceil(n / float(binsize)))
+
+def get_m4_indices(y, width):
+    """
+    Return the row indices of the M4 aggregation of y, a N x channels array,
+    over at most width pixel columns: for each column and channel, the
+    first, min, max and last samples, in the order of the data.
+    The returned array is (4 * columns) x channels.
+    """
+    n, nchannels = y.shape
+    binsize, ncols = get_m4_columns(n, width)
+    if ncols * binsize > n:
+        # complete the last column with the last sample
+        padded = np.empty((ncols * binsize, nchannels), dtype=y.dtype)
+        padded[:n] = y
+        padded[n:] = y[-1]
+        y = padded
+    y = y.reshape((ncols, binsize, nchannels))
+    imin = y.argmin(axis=1)
+    imax = y.argmax(axis=1)
+    offset = (np.arange(ncols) * binsize).reshape((-1, 1))
+    indices = np.empty((ncols, 4, nchannels), dtype=np.intp)
+    indices[:, 0] = offset
+    indices[:, 1] = offset + np.minimum(imin, imax)
+    indices[:, 2] = offset + np.maximum(imin, imax)
+    indices[:, 3] = np.minimum(offset + binsize - 1, n - 1)
+    return indices.reshape((4 * ncols, nchannels))
+
+def m4(y, width):
+    """
+    M4 aggregation of y, a N x channels array, over width pixel columns.
+    Return (indices, values), two (4 * columns) x channels arrays with the
+    row indices and the values of the selected samples. The vertex count is
+    then bounded by the width instead of N, and the drawn lines are the same
+    as with all the samples.
+    """
+    y = np.asarray(y)
+    indices = get_m4_indices(y, width)
+    values = y[indices, np.arange(y.shape[1])]
+    return indices, values
+
+def lttb(y, npoints, x=None):
+    """
+    Largest-Triangle-Three-Buckets downsampling of y, a N x channels array,
+    to npoints points per channel. x contains the N x coordinates, shared by
+    the channels, by default the row indices.
+    The first and last samples are kept, and the other ones are split into
+    npoints - 2 buckets. In each bucket, the sample which makes the largest
+    triangle with the previously selected sample and the mean of the next
+    bucket is selected. The buckets depend on each other, but each one is
+    processed for all its samples and channels at once.
+    Return (indices, values), two npoints x channels arrays with the row
+    indices and the values of the selected samples.
+    """
+    y = np.asarray(y)
+    n, nchannels = y.shape
+    ch = np.arange(nchannels)
+    npoints = max(npoints, 3)
+    if npoints >= n:
+        indices = np.tile(np.arange(n).reshape((-1, 1)), (1, nchannels))
+        return indices, y[indices, ch]
+    if x is None:
+        x = np.arange(n, dtype=np.float64)
+    else:
+        x = np.asarray(x, dtype=np.float64)
+    # bucket k contains the rows bounds[k]:bounds[k + 1]
+    bounds = (np.arange(npoints - 1) * ((n - 2) / float(npoints - 2))).astype(int) + 1
+    sizes = np.diff(bounds).reshape((-1, 1))
+    # mean of each bucket, with cumulative sums
+    ysum = np.zeros((n + 1, nchannels))
+    np.cumsum(y, axis=0, out=ysum[1:])
+    xsum = np.zeros(n + 1)
+    np.cumsum(x, out=xsum[1:])
+    ymean = (ysum[bounds[1:]] - ysum[bounds[:-1]]) / sizes
+    xmean = (xsum[bounds[1:]] - xsum[bounds[:-1]]) / sizes[:, 0]
+    # third point of the triangles: mean of the next bucket, or last sample
+    yc = np.vstack((ymean[1:], y[-1:]))
+    xc = np.hstack((xmean[1:], x[-1:]))
+
+    indices = np.empty((npoints, nchannels), dtype=np.intp)
+    indices[0] = 0
+    indices[-1] = n - 1
+    x2 = x.reshape((-1, 1))
+    xa, ya = np.zeros(nchannels) + x[0], np.array(y[0], dtype=np.float64)
+    for k in xrange(npoints - 2):
+        i0, i1 = bounds[k], bounds[k + 1]
+        # twice the area of the triangles (a, b, c) is |u * yb + v * xb + w|
+        u = xa - xc[k]
+        v = yc[k] - ya
+        w = -u * ya - v * xa
+        area = u * y[i0:i1]
+        area += v * x2[i0:i1]
+        area += w
+        best = np.abs(area, out=area).argmax(axis=0)
+        best += i0
+        indices[k + 1] = best
+        xa, ya = x[best], y[best, ch]
+    return indices, y[indices, ch]
+
+# number of LTTB points per pixel column when decimating to a pixel width
+LTTB_POINTS_PER_COLUMN = 2
+
+def get_decimated_rows(n, width, method="m4"):
+    """
+    Return the number of rows returned by decimate for n rows.
+    """
+    if method == "m4":
+        return 4 * get_m4_columns(n, width)[1]
+    elif method == "lttb":
+        npoints = max(LTTB_POINTS_PER_COLUMN * width, 3)
+        return n if npoints >= n else npoints
+    raise ValueError("Unknown decimation method <%s>" % method)
+
+def decimate(y, width, method="m4"):
+    """
+    Decimate y, a N x channels array, for a display of width pixel columns
+    with the given method, "m4" or "lttb". Return (indices, values).
+    """
+    if method == "m4":
+        return m4(y, width)
+    elif method == "lttb":
+        return lttb(y, LTTB_POINTS_PER_COLUMN * width)
+    raise ValueError("Unknown decimation method <%s>" % method)
@@ -9,7 +9,13 @@ class DynamicViewport(object):
     
     def __init__(self, duration, xmin = 0.0):
         self.xmin = xmin
-        self.xmax = xmin + duration
+        self.set_duration(duration)
+        
+    def set_duration(self, duration):
+        """
+        Set the duration of the data, which can grow while it is acquired.
+        """
+        self.xmax = self.xmin + duration
         self.max_viewportindex = int(duration/self.viewportsize)
         
     def get_viewport_index(self, x):
@@ -35,6 +41,25 @@ class DynamicViewport(object):
             databuffer = (x0v - side, min(x1v + side, self.xmax))
         return databuffer
         
+    def get_next_databuffers(self, index, direction, count=1):
+        """
+        Return the data buffers of the count viewports following the viewport
+        index in the given direction (1 or -1), which are not in the current
+        data buffer.
+        """
+        databuffers = []
+        for i in xrange(1, count + 1):
+            nextindex = index + i * direction
+            if not 0 <= nextindex <= self.max_viewportindex:
+                break
+            databuffer = self.get_databuffer(self.get_viewport(nextindex))
+            if (databuffer[0] >= self.databuffer[0]) & (databuffer[1] <= self.databuffer[1]):
+                continue
+            if databuffer in databuffers:
+                continue
+            databuffers.append(databuffer)
+        return databuffers
+        
     # def update_viewport(self, index):
     def update_viewport(self, viewport):
         self.viewport = viewport
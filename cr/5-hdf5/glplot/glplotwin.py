@@ -30,6 +30,7 @@ For now, the interactive commands are:
   * CTRL + wheel for x-scaling
   * SHIFT + wheel for y-scaling
   * R: reset the view
+  * Y: fit the y range to the visible window
   * Home key or G: beginning of the trace
   * End key or H: end of the trace
   * F: toggle fullscreen/normal
@@ -104,6 +105,8 @@ class GLPlot(QtGui.QMainWindow):
         
         # nav commands
         self.addMenuItem('&Reset', 'R', 'Reset', self.reset, self.navMenu)
+        self.addMenuItem('&Autoscale', 'Y', 'Fit the y range to the view',
+                         self.autoscaleEvent, self.navMenu)
         self.addMenuItem('&Start', [QtCore.Qt.Key_Home, 'G'], 'Start', self.startEvent, self.navMenu)
         self.addMenuItem('&End', [QtCore.Qt.Key_End, 'H'], 'End', self.endEvent, self.navMenu)
         self.addMenuItem('&Fullscreen', 'F', 'Toggle fullscreen mode', \
@@ -144,6 +147,9 @@ class GLPlot(QtGui.QMainWindow):
         self.glWidget.reset()
         self.navSlider.setValue(self.navSlider.minimum())
     
+    def autoscaleEvent(self, e):
+        self.glWidget.autoscale()
+    
     def startEvent(self, e):
         self.sliderChangedValue(self.navSlider.minimum())
         self.navSlider.setValue(self.navSlider.minimum())
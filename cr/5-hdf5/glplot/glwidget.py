@@ -27,6 +27,11 @@ class GLWidget(QtOpenGL.QGLWidget):
     w, h = 1024, 768
     
     isInitialized = False
+    # the navigation events only update the navigation state and schedule a
+    # redraw: the redraws are coalesced by a timer, at most maxfps per second
+    maxfps = 60.
+    redrawTimer = None
+    lastframe = 0.
     
     def __init__(self, parent=None):
         super(GLWidget, self).__init__(parent)
@@ -39,6 +44,9 @@ class GLWidget(QtOpenGL.QGLWidget):
         
         # self.navigateSignal.connect(self.navigateEvent)
         SIGNALS.navigateSignal.connect(self.navigateEvent)
+        self.redrawTimer = QtCore.QTimer(self)
+        self.redrawTimer.setSingleShot(True)
+        self.redrawTimer.timeout.connect(self.redraw)
 
     def minimumSizeHint(self):
         return QtCore.QSize(50, 50)
@@ -79,6 +87,20 @@ class GLWidget(QtOpenGL.QGLWidget):
         self.keyReleaseEvent(None)
         
     def navigateEvent(self):
+        self.scheduleRedraw()
+        
+    def scheduleRedraw(self):
+        """
+        Redraw at the next frame, one frame period after the last one: the
+        events until then are drawn by a single updateGL.
+        """
+        if self.redrawTimer.isActive():
+            return
+        delay = self.lastframe + 1. / self.maxfps - time.time()
+        self.redrawTimer.start(max(0, int(delay * 1000)))
+        
+    def redraw(self):
+        self.lastframe = time.time()
         self.updateGL()
         
     def mousePressEvent(self, event):
@@ -144,11 +166,18 @@ class GLWidget(QtOpenGL.QGLWidget):
     def slide(self, x, max):
         # slide, and update only if the transform is not null
         if (self.nav.slide(x, max)):
-            self.updateGL()
+            self.scheduleRedraw()
         
     def reset(self):
         self.nav.reset()
         SIGNALS.navigateSignal.emit()
+        
+    def autoscale(self):
+        """
+        Fit the y range to the visible window, if possible without reading
+        the data. Return True if the range has changed.
+        """
+        return False
     
     def load_data(self, data, databounds=None, options=None):
         self.dataDisplay.load(data, databounds, options=options)
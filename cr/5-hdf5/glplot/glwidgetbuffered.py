@@ -1,16 +1,24 @@
 import sys
 import time
+import logging
+import threading
 import numpy as np
 from numpy import *
+from PyQt4 import QtCore
 from glwidget import GLWidget
 from navigationbuffered import NavigationBuffered
 from navigationinterface import NavigationInterface
 from signals import SIGNALS
-from datadisplay import DataDisplay
+from datadisplay import DataDisplay, YDataDisplay, CircularYDataDisplay, \
+    is_complete, MAXSLOTS
 from h5 import *
 from colors import *
 from dynamicviewport import DynamicViewport
-from dataproxy import H5DataProxy, DataProxy
+from dataproxy import H5DataProxy, DataProxy, MemmapDataProxy
+from prefetcher import Prefetcher
+from asyncproxy import AsyncDataProxy, copy_result
+
+log = logging.getLogger(__name__)
 
     
 def get_options(opt, lw):
@@ -37,26 +45,117 @@ def get_options(opt, lw):
 class GLWidgetBuffered(GLWidget):
     channels = 1
     duration = 1
+    # visible channels (see h5.get_channel_selection), None for all channels
+    visible_channels = None
+    # read one sample every step samples
+    step = None
+    # "xy" to upload (x, y) vertices, "y" to upload only the y values and
+    # compute x on the GPU
+    layout = "xy"
+    # with the "y" layout, dtype of the uploaded y values, np.int16 to upload
+    # raw int16 recordings, and gain and offset of each channel (by default
+    # 1 and 0) applied in the vertex shader
+    ydtype = np.float32
+    channel_gains = None
+    channel_offsets = None
+    # with the "y" layout, keep the data buffer in a circular vertex buffer of
+    # one slot per viewport, and only read and upload the newly exposed
+    # viewports when the data buffer shifts
+    circular = False
+    slotkey = None
+    slotviewports = None
+    # with the "xy" layout, reduce the data buffer to a few samples per pixel
+    # column, with the "m4" or "lttb" decimation (see decimation.py)
+    decimate = False
+    decimation = "m4"
+    # decimate the data buffer again when the zoom changes its width in
+    # pixels by more than this ratio
+    redecimateratio = 1.5
+    pixelwidth = None
+    # block cache shared by the HDF5 proxies of all the widgets, for example
+    # a blockcache.SharedBlockCache to share it with other processes too
+    cache = None
+    # follow mode: keep the view on the newest data while it is acquired
+    follow = False
+    followTimer = None
+    # load the next data buffers in the direction of the navigation, when it
+    # is faster than prefetch_minvelocity viewports per second
+    prefetch = True
+    prefetch_minvelocity = .05
+    prefetcher = None
+    lastprefetch = None
+    # read the new data buffers in background threads: paintGL draws the
+    # resident data, and the new buffer is uploaded by the next frame after
+    # it has been read. The results are copied into a ring of preallocated
+    # buffers, see get_result_count
+    asyncload = True
+    asyncworkers = 2
+    asyncproxy = None
+    loading = None  # data buffer being loaded
+    loadingrequests = ()
+    # emitted by the loader threads when a data buffer has been read
+    loadedSignal = QtCore.pyqtSignal()
+    # after a failed load, the resident data is drawn and the data buffer is
+    # loaded again after this delay in seconds
+    retrydelay = 1.
+    retrybuffer = None
     
     def __init__(self, parent=None):
         super(GLWidgetBuffered, self).__init__(parent)
+        self.fetched = {}  # results of the loader, see read_data
+        self.pending = set()  # futures of the data buffer being loaded
+        self.pendinglock = threading.Lock()
+        # queued, so that a frame is never scheduled from another thread
+        self.loadedSignal.connect(self.scheduleRedraw,
+                                  QtCore.Qt.QueuedConnection)
+        self.retryTimer = QtCore.QTimer(self)
+        self.retryTimer.setSingleShot(True)
+        self.retryTimer.timeout.connect(self.retry_loading)
         self.nav = NavigationBuffered()
         self.navInterface = NavigationInterface(self.nav)
         self.nav.sxmin = 1.  #/self.maxviewportsize
+        if self.layout == "y" and self.circular:
+            self.dataDisplay = CircularYDataDisplay()
+        elif self.layout == "y":
+            self.dataDisplay = YDataDisplay()
         
-    def load_data(self, data, freq=None):
+    def load_data(self, data, freq=None, channels=None, dtype=None):
+        """
+        data can be a h5py dataset, a NumPy array with one column per channel,
+        or the path of a binary DAT file, which is then memory-mapped with
+        the given number of channels and dtype.
+        """
         self.data = data
         if type(data) is h5py.Dataset:
             self.channels = data.attrs["channels"]
             self.duration = data.attrs["duration"]
             self.freq = data.attrs["freq"]
-            self.dataproxy = H5DataProxy(data)
+            self.dataproxy = H5DataProxy(data, cache=self.cache)
+        elif isinstance(data, basestring):
+            self.dataproxy = MemmapDataProxy(data, channels, freq, dtype=dtype)
+            self.data = self.dataproxy.fulldata
+            self.channels = self.dataproxy.channels
+            self.duration = self.dataproxy.duration
+            self.freq = freq
         else:
             self.channels = data.shape[1]
             self.duration = (data.shape[0] - 1) / float(freq)
             self.freq = freq
             self.dataproxy = DataProxy(data, freq)
         
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.prefetch:
+            self.prefetcher = Prefetcher(self.dataproxy)
+        self.lastprefetch = None
+        if self.asyncproxy is not None:
+            self.asyncproxy.shutdown(wait=False)
+            self.asyncproxy = None
+        self.cancel_loading()
+        if self.asyncload:
+            self.asyncproxy = AsyncDataProxy(self.dataproxy,
+                workers=self.asyncworkers, nresults=self.get_result_count())
+        
         self.dynamicviewport = DynamicViewport(self.duration)
         
         # max translation, used for the slider
@@ -66,8 +165,9 @@ class GLWidgetBuffered(GLWidget):
         
         # get the first view port and data buffer to load the data at first
         viewport = self.dynamicviewport.get_viewport(0)
-        data = self.update_data(self.dynamicviewport.get_databuffer(viewport),\
-                                viewport)
+        self.dynamicviewport.update_viewport(viewport)
+        self.nav.set_offsetx(self.dynamicviewport.databuffer[0])
+        data = self.update_data(self.dynamicviewport.databuffer, viewport)
         
         # reload if already initialized
         if self.isInitialized:
@@ -87,29 +187,432 @@ class GLWidgetBuffered(GLWidget):
         # get the data buffer x coordinates (x0, x1)
         changed = self.dynamicviewport.update_viewport(viewport)
         
-        # databuffer = self.dynamicviewport.get_databuffer(viewport)
-        self.nav.set_offsetx(self.dynamicviewport.databuffer[0])
+        # request the new data buffer if needed, and upload it when it has
+        # been read: until then, the resident data is drawn where it was
+        if changed:
+            print "Load (%.1fs, %.1fs)" % (self.dynamicviewport.databuffer)
+            self.request_data(self.dynamicviewport.databuffer)
+        elif self.loading is None and self.is_decimation_stale():
+            self.request_data(self.dynamicviewport.databuffer)
+        if self.loading is not None:
+            self.upload_data()
+        
         # translate the data, using the compensation of the translation with offsetx
         self.dataDisplay.transform(tx + self.nav.offsetx, ty, sx, sy)
-                        
-        # update the viewport and the data buffer if needed
-        # if self.dynamicviewport.update_viewport(viewportindex):
-        if changed: #self.dynamicviewport.update_viewport(viewport):
-            print "Load (%.1fs, %.1fs)" % (self.dynamicviewport.databuffer)
-            self.update_data(self.dynamicviewport.databuffer, renormalize=False)
+        
+        if self.prefetcher is not None:
+            self.prefetch_next(viewportindex)
+        
+        self.dataDisplay.paint()
+        
+    def get_result_count(self):
+        """
+        Return the number of results of the loader threads which can be
+        alive at the same time, and so the number of buffers they are copied
+        into: the requests of a data buffer, those still running for the
+        previous ones, and the data loaded in the display.
+        """
+        if self.layout == "y" and self.circular:
+            requests = MAXSLOTS
+        else:
+            requests = 1
+        return requests + self.asyncworkers + 1
+        
+    def request_data(self, databuffer):
+        """
+        Start loading a data buffer: the loader threads read it, or if
+        asyncload is False, the next upload_data reads it.
+        """
+        self.loading = databuffer
+        self.retrybuffer = None
+        self.fetched.clear()
+        self.pixelwidth = self.get_pixel_width(databuffer)
+        if self.asyncproxy is None:
+            return
+        requests = self.get_requests(databuffer)
+        futures = [self.asyncproxy.request(d, offsetx=offsetx,
+                                           channels=self.visible_channels,
+                                           step=self.step, method=method,
+                                           **kwargs)
+                   for method, d, offsetx, kwargs in requests]
+        # the buffers which have been passed are not needed anymore
+        self.asyncproxy.cancel_stale(keep=futures)
+        self.loadingrequests = zip(requests, futures)
+        with self.pendinglock:
+            self.pending = set(futures)
+        for future in futures:
+            future.add_done_callback(self.data_loaded)
+        
+    def data_loaded(self, future):
+        # called by a loader thread: when the whole data buffer has been
+        # read, paint a frame, which uploads it
+        with self.pendinglock:
+            if future not in self.pending:
+                return  # cancelled or replaced
+            self.pending.discard(future)
+            if self.pending:
+                return
+        self.loadedSignal.emit()
+        
+    def cancel_loading(self):
+        self.loading = None
+        self.loadingrequests = ()
+        with self.pendinglock:
+            self.pending = set()
+        self.retrybuffer = None
+        self.fetched.clear()
+        if self.asyncproxy is not None:
+            self.asyncproxy.cancel_stale()
+        
+    def upload_data(self):
+        """
+        Load the data buffer being loaded in the display, if it has been read.
+        Return True if it has been loaded.
+        """
+        if [future for request, future in self.loadingrequests
+            if not future.done()]:
+            return False
+        failed = False
+        for (method, databuffer, offsetx, kwargs), future in \
+                self.loadingrequests:
+            try:
+                self.fetched[(method, tuple(databuffer), offsetx)] = \
+                    future.result()
+            except Exception, e:
+                log.warning("Failed to load (%.1fs, %.1fs): %s",
+                            databuffer[0], databuffer[1], e)
+                failed = True
+        databuffer = self.loading
+        self.loading = None
+        self.loadingrequests = ()
+        if failed:
+            # keep drawing the resident data, and load the data buffer again
+            # later rather than reading it in paintGL
+            self.fetched.clear()
+            self.retrybuffer = databuffer
+            self.retryTimer.start(int(self.retrydelay * 1000))
+            return False
+        self.nav.set_offsetx(databuffer[0])
+        self.update_data(databuffer, renormalize=False)
+        self.fetched.clear()
+        self.dataDisplay.bind_data_buffer()
+        return True
+        
+    def retry_loading(self):
+        # unless another data buffer has been requested since the failure
+        databuffer = self.retrybuffer
+        self.retrybuffer = None
+        if databuffer is None or self.loading is not None or \
+                tuple(databuffer) != tuple(self.dynamicviewport.databuffer):
+            return
+        self.request_data(databuffer)
+        self.scheduleRedraw()
+        
+    def get_requests(self, databuffer):
+        """
+        Return the list of (method, databuffer, offsetx, kwargs) of the proxy
+        calls which read a data buffer, see read_data. With the circular
+        vertex buffer, only the missing viewports are read.
+        """
+        if self.layout == "y" and self.circular:
+            viewports, nslots = self.get_slot_viewports(databuffer)
+            return [("get_yonly", self.dynamicviewport.get_viewport(index), 0.,
+                     dict(dtype=self.ydtype))
+                    for index in viewports
+                    if self.get_resident_slot(index, nslots) is None]
+        if self.layout == "y":
+            return [("get_yonly", databuffer, databuffer[0],
+                     dict(dtype=self.ydtype))]
+        return [("get", databuffer, databuffer[0],
+                 dict(width=self.pixelwidth,
+                      decimation=self.decimation))]
+        
+    def read_data(self, method, databuffer, offsetx, **kwargs):
+        """
+        Return dataproxy.<method>(databuffer, offsetx, ...) for the visible
+        channels, from the results of the loader threads if they have read
+        it.
+        """
+        key = (method, tuple(databuffer), offsetx)
+        if key in self.fetched:
+            return self.fetched.pop(key)
+        if self.asyncproxy is None:
+            return getattr(self.dataproxy, method)(databuffer, offsetx=offsetx,
+                channels=self.visible_channels, step=self.step, **kwargs)
+        # the loader threads use the proxy and its buffers too
+        with self.asyncproxy.proxylock:
+            return copy_result(getattr(self.dataproxy, method)(databuffer,
+                offsetx=offsetx, channels=self.visible_channels,
+                step=self.step, **kwargs), self.asyncproxy.ring)
+        
+    def prefetch_next(self, viewportindex):
+        """
+        Prefetch the data buffers of the next viewports in the direction of
+        the navigation: one, or two if it moves faster than one viewport per
+        second.
+        """
+        velocity = self.nav.update_velocity()
+        viewportsize = self.dynamicviewport.viewportsize
+        if abs(velocity) < self.prefetch_minvelocity * viewportsize:
+            return
+        direction = 1 if velocity > 0 else -1
+        count = 2 if abs(velocity) > viewportsize else 1
+        request = (viewportindex, direction, count, self.visible_channels,
+                   self.step)
+        if request == self.lastprefetch:
+            return
+        self.lastprefetch = request
+        databuffers = self.dynamicviewport.get_next_databuffers(viewportindex,
+                                                                direction, count)
+        if databuffers:
+            self.prefetcher.request(databuffers, channels=self.visible_channels,
+                                    step=self.step)
+        
+    def get_view(self):
+        """
+        Return the (x0, x1) data range of the visible window.
+        """
+        x0, y0 = self.nav.get_data_coordinates()
+        sx, sy = self.nav.get_scale()
+        return x0, x0 + 1. / sx
+        
+    def autoscale(self):
+        """
+        Fit the y range to the visible window. The range comes from the
+        min/max index of the HDF5 file, or from its statistics, without
+        reading the data.
+        """
+        yrange = self.get_physical_yrange(self.get_view())
+        if yrange is None:
+            return False
+        xmin, xmax, ymin, ymax = self.dataDisplay.get_bounds()
+        # the display reverses y, and normalizes the data on the GPU so it
+        # does not need to be loaded again
+        self.dataDisplay.set_bounds(xmin, xmax, -float(yrange[1]),
+                                    -float(yrange[0]))
+        if self.isInitialized:
+            self.updateGL()
+        return True
+        
+    def get_physical_yrange(self, databuffer):
+        """
+        Return the (min, max) of the visible channels over the data buffer,
+        with their gains and offsets in the "y" layout, or None if the proxy
+        does not know it.
+        """
+        gains = self.get_channel_values(self.channel_gains)
+        offsets = self.get_channel_values(self.channel_offsets)
+        if self.layout != "y" or (gains is None and offsets is None):
+            return self.dataproxy.get_yrange(self.visible_channels,
+                                             databuffer=databuffer)
+        channels = np.arange(self.channels)[
+            get_channel_selection(self.visible_channels)]
+        if gains is None:
+            gains = np.ones(len(channels))
+        if offsets is None:
+            offsets = np.zeros(len(channels))
+        # the range of each channel, since they have different gains
+        ymin, ymax = None, None
+        for channel, gain, offset in zip(channels, gains, offsets):
+            yrange = self.dataproxy.get_yrange(int(channel),
+                                               databuffer=databuffer)
+            if yrange is None:
+                return None
+            y0, y1 = sorted(gain * float(y) + offset for y in yrange)
+            ymin = y0 if ymin is None else min(ymin, y0)
+            ymax = y1 if ymax is None else max(ymax, y1)
+        if ymin is None:
+            return None
+        return ymin, ymax
+        
+    def set_visible_channels(self, channels, step=None):
+        """
+        Only read and display the given channels, and one sample every step
+        samples.
+        """
+        self.visible_channels = channels
+        self.step = step
+        self.cancel_loading()
+        self.update_data(renormalize=False)
+        if self.isInitialized:
             self.dataDisplay.bind_data_buffer()
             self.updateGL()
         
-        self.dataDisplay.paint()
+    def set_follow(self, follow=True, period=500):
+        """
+        Check for new data every period ms, extend the duration and the
+        viewport bounds, and keep the view pinned to the newest data.
+        """
+        self.follow = follow
+        if self.followTimer is None:
+            self.followTimer = QtCore.QTimer(self)
+            self.followTimer.timeout.connect(self.refresh_data)
+        if follow:
+            self.followTimer.start(period)
+        else:
+            self.followTimer.stop()
+        
+    def refresh_data(self):
+        if not self.dataproxy.refresh():
+            return
+        self.duration = self.dataproxy.duration
+        self.dynamicviewport.set_duration(self.duration)
+        self.nav.xmax = self.dynamicviewport.xmax
+        self.nav.txmax = self.duration - self.dynamicviewport.viewportsize
+        if self.follow:
+            self.nav.slide(1., 1.)
+        SIGNALS.navigateSignal.emit()
+        
+    def get_pixel_width(self, databuffer):
+        """
+        Return the number of pixel columns spanned by the data buffer at the
+        current zoom level, or None if the data is not decimated.
+        """
+        if not self.decimate:
+            return None
+        x0, x1 = databuffer
+        # the widget shows 1/sx data units
+        sx, sy = self.nav.get_scale()
+        return max(1, int(np.ceil(self.width() * sx * (x1 - x0))))
+        
+    def is_decimation_stale(self):
+        """
+        Return True if the zoom has changed the pixel width of the data
+        buffer by more than redecimateratio since it was decimated.
+        """
+        databuffer = self.dynamicviewport.databuffer
+        width = self.get_pixel_width(databuffer)
+        if self.layout != "xy" or width is None or self.pixelwidth is None:
+            return False
+        # the data is only decimated if it has more than 4 rows per pixel
+        rows = (databuffer[1] - databuffer[0]) * self.freq / (self.step or 1)
+        if rows <= 4 * min(width, self.pixelwidth):
+            return False
+        ratio = float(width) / self.pixelwidth
+        return not 1. / self.redecimateratio <= ratio <= self.redecimateratio
+        
+    def get_channel_values(self, values):
+        # values of the visible channels, from per-channel values
+        if values is None:
+            return None
+        return np.asarray(values)[get_channel_selection(self.visible_channels)]
+        
+    def get_channel_count(self):
+        # number of visible channels
+        channels = np.arange(self.channels)
+        return channels[get_channel_selection(self.visible_channels)].size
         
     def update_data(self, databuffer=None, renormalize=True):
         if databuffer is None:
             databuffer = self.dynamicviewport.databuffer
-        data = self.dataproxy.get(databuffer, offsetx=self.nav.offsetx)
-        n = data.shape[0] / self.channels
-        databounds = [i * n for i in xrange(self.channels + 1)]
+        gains = self.get_channel_values(self.channel_gains)
+        offsets = self.get_channel_values(self.channel_offsets)
+        if type(renormalize) is tuple and len(renormalize) == 2 and \
+                gains is None and offsets is None:
+            # x range of the viewport, and saved range of the channels instead
+            # of scanning the data
+            yrange = self.dataproxy.get_yrange(self.visible_channels)
+            if yrange is not None:
+                # the display reverses y
+                renormalize = tuple(renormalize) + (-float(yrange[1]),
+                                                    -float(yrange[0]))
+        if self.layout == "y" and self.circular:
+            return self.update_slots(databuffer, renormalize, gains, offsets)
+        if self.layout == "y":
+            data, x = self.read_data("get_yonly", databuffer, self.nav.offsetx,
+                                     dtype=self.ydtype)
+        else:
+            if not self.fetched:
+                # otherwise, decimated by the loader threads for the width
+                # of request_data
+                self.pixelwidth = self.get_pixel_width(databuffer)
+            data = self.read_data("get", databuffer, self.nav.offsetx,
+                                  width=self.pixelwidth,
+                                  decimation=self.decimation)
+        channels = self.get_channel_count()
+        n = data.shape[0] / max(channels, 1)
+        databounds = [i * n for i in xrange(channels + 1)]
         # TODO: allow options
-        options = [get_options(None, 1.0) for _ in xrange(self.channels)]
-        self.dataDisplay.load(data, databounds, options=options, renormalize=renormalize)
+        options = [get_options(None, 1.0) for _ in xrange(channels)]
+        if self.layout == "y":
+            self.dataDisplay.load(data, databounds, options=options,
+                                  renormalize=renormalize, x=x,
+                                  gains=gains, offsets=offsets)
+        else:
+            self.dataDisplay.load(data, databounds, options=options, renormalize=renormalize)
         
         return data
+        
+    def update_slots(self, databuffer, renormalize=False, gains=None,
+                     offsets=None):
+        """
+        Load the data buffer in the circular vertex buffer of the display,
+        one slot per viewport. Only the viewports which are not in a slot
+        yet are read, and the next bind_data_buffer only uploads them.
+        """
+        display = self.dataDisplay
+        dv = self.dynamicviewport
+        viewports, nslots = self.get_slot_viewports(databuffer)
+        key = (repr(self.visible_channels), self.step,
+               np.dtype(self.ydtype).str, nslots, id(self.dataproxy))
+        if key != self.slotkey:
+            # everything has to be read again
+            self.slotkey = key
+            self.slotviewports = {}
+        slots = []
+        for index in viewports:
+            resident = self.get_resident_slot(index, nslots)
+            if resident is not None:
+                slots.append(resident)
+                continue
+            slot = index % nslots
+            viewport = dv.get_viewport(index)
+            y, (slotx0, dx) = self.read_data("get_yonly", viewport, 0.,
+                                             dtype=self.ydtype)
+            channels = self.get_channel_count()
+            y = y.reshape((channels, -1))
+            if not self.slotviewports:
+                # the slots hold one viewport and the first sample of the next
+                options = [get_options(None, 1.0) for _ in xrange(channels)]
+                if dx > 0:
+                    slotrows = dv.viewportsize / dx
+                else:
+                    # a viewport of a single row has no x step
+                    slotrows = dv.viewportsize * self.freq / (self.step or 1)
+                display.allocate(channels, nslots, int(np.ceil(slotrows)) + 2,
+                                 y.dtype, options=options)
+            rows = display.set_slot(slot, y, slotx0, dx,
+                                    scan=not is_complete(renormalize))
+            # the last viewport grows while the data is acquired
+            complete = viewport[1] < dv.xmax
+            self.slotviewports[slot] = (index, complete, slot, slotx0, rows)
+            slots.append((slot, slotx0, rows))
+        display.set_gains(gains, offsets)
+        display.offsetx = self.nav.offsetx
+        display.set_slots(slots)
+        if renormalize is not False:
+            display.update_slot_bounds(renormalize)
+        
+    def get_slot_viewports(self, databuffer):
+        """
+        Return the indices of the viewports of a data buffer, and the number
+        of slots of the circular vertex buffer.
+        """
+        dv = self.dynamicviewport
+        vsize = dv.viewportsize
+        x0, x1 = databuffer
+        i0 = int(np.floor((x0 - dv.xmin) / vsize + 1e-6))
+        i1 = int(np.ceil((x1 - dv.xmin) / vsize - 1e-6))
+        # one more slot than the viewports of a data buffer, in case it is
+        # not aligned on the viewports
+        nslots = int(np.ceil(dv.databuffersize / vsize - 1e-6)) + 1
+        return range(i0, max(i1, i0 + 1)), nslots
+        
+    def get_resident_slot(self, index, nslots):
+        # (slot, x0, rows) of a viewport already in a slot, or None
+        if not self.slotviewports:
+            return None
+        resident = self.slotviewports.get(index % nslots)
+        if resident is not None and resident[:2] == (index, True):
+            return resident[2:]
+        return None
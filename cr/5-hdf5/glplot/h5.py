@@ -1,26 +1,586 @@
 import numpy as np
 import h5py
 import os.path
+import sys
+import tempfile
+import time
+import threading
+import Queue
+from fractions import gcd
+from progressreporting import ProgressReporter
 
-def load_hdf5(file):
-    f = h5py.File(file, "r")
+def load_hdf5(file, swmr=False):
+    """
+    Open the RawData dataset of an HDF5 file. With swmr=True, the file is
+    opened in single-writer multiple-reader mode, so that the rows appended
+    by a writer can be seen with Dataset.refresh.
+    """
+    if swmr:
+        f = h5py.File(file, "r", libver="latest", swmr=True)
+    else:
+        f = h5py.File(file, "r")
     data = f["RawData"]
     return data
+
+def is_swmr(data):
+    """
+    Return True if the file of a dataset is open for SWMR reading.
+    """
+    swmr_read = getattr(h5py.h5f, "ACC_SWMR_READ", 0)
+    return bool(data.file.id.get_intent() & swmr_read)
     
-def read_hdf5(data, fromtime, duration):
-    channels = data.attrs["channels"]
+def get_channel_selection(channels):
+    """
+    Return the HDF5 selection of a set of channels, given as None (all the
+    channels), an int, a slice, a (start, stop) range, or a list of channels
+    and (start, stop) ranges. Contiguous channels give a slice, i.e. a single
+    hyperslab; the others give a sorted list of channels.
+    """
+    if channels is None:
+        return slice(None)
+    if isinstance(channels, slice):
+        return channels
+    if isinstance(channels, (int, long, np.integer)):
+        return slice(channels, channels + 1)
+    if isinstance(channels, tuple):
+        return slice(*channels)
+    indices = set()
+    for c in channels:
+        if isinstance(c, tuple):
+            indices.update(xrange(*c))
+        else:
+            indices.add(int(c))
+    indices = sorted(indices)
+    if not indices:
+        return slice(0, 0)
+    if indices[-1] - indices[0] + 1 == len(indices):
+        return slice(indices[0], indices[-1] + 1)
+    return indices
+
+def get_selection_size(selection, channels):
+    """
+    Return the number of channels in a selection returned by
+    get_channel_selection, out of ``channels`` channels.
+    """
+    if isinstance(selection, slice):
+        return len(xrange(*selection.indices(channels)))
+    return len(selection)
+
+def read_hdf5(data, fromtime, duration, channels=None, step=None):
+    """
+    Read a time window of a dataset, optionally restricted to some channels
+    (see get_channel_selection) and to one row every ``step`` rows. The
+    selection is done by HDF5, so that only the selected values are read
+    from the disk. Use select_level to read min/max decimated data instead.
+    """
     freq = data.attrs["freq"]
     fromrow = int(round(fromtime * freq))
     torow = int(round((fromtime + duration) * freq))
-    return data[fromrow:torow + 1]
+    return data[fromrow:torow + 1:step, get_channel_selection(channels)]
 
 def close_hdf5(data):
     data.file.close()
 
+def load_pyramid(data):
+    """
+    Return the list of (factor, dataset) min/max levels stored next to a
+    RawData dataset, sorted by increasing decimation factor.
+    """
+    if "Pyramid" not in data.file:
+        return []
+    levels = [(level.attrs["factor"], level)
+              for level in data.file["Pyramid"].itervalues()]
+    return sorted(levels, key=lambda (factor, level): factor)
+
+def select_level(data, fromtime, duration, minrows):
+    """
+    Return the coarsest dataset, among RawData and its min/max levels, that
+    still has at least ``minrows`` rows in the given time window. The levels
+    have the same attributes as RawData, so that ``read_hdf5`` can be used on
+    them.
+    """
+    if minrows is None:
+        return data
+    rawrows = duration * data.attrs["freq"]
+    source = data
+    for factor, level in load_pyramid(data):
+        if rawrows * 2. / factor < minrows:
+            break
+        source = level
+    return source
+
+
+def get_totalrows(fromfile, channels, dtype):
+    """
+    Return the number of complete rows in a binary array file.
+    """
+    totalsize = os.path.getsize(fromfile)  # size in bytes of fromfile
+    return totalsize // (dtype.itemsize * channels)
+
+def iter_chunks(fromfile, channels, dtype, chunkrows, fromrow=0):
+    """
+    Yield (row, array) chunks of a binary array file from row fromrow,
+    with f.read.
+    """
+    chunksize = chunkrows * dtype.itemsize * channels
+    f = open(fromfile, "rb")
+    f.seek(fromrow * dtype.itemsize * channels)
+    currow = fromrow
+    try:
+        while True:
+            s = f.read(chunksize)  # read chunksize bytes from the file
+            if not s:
+                break
+            x = np.fromstring(s, dtype=dtype)  # convert to a Numpy array
+            x = x.reshape((-1, channels))  # and resize it
+            yield currow, x
+            currow += x.shape[0]
+    finally:
+        f.close()
+
+def iter_mmap_chunks(fromfile, channels, dtype, chunkrows, fromrow=0):
+    """
+    Yield (row, array) chunks of a binary array file from row fromrow,
+    with a memory map.
+    Each chunk is copied out of the map so that the disk reads happen
+    in the thread consuming this generator.
+    """
+    totalrows = get_totalrows(fromfile, channels, dtype)
+    if totalrows == 0:
+        return
+    m = np.memmap(fromfile, dtype=dtype, mode="r", shape=(totalrows, channels))
+    for currow in xrange(fromrow, totalrows, chunkrows):
+        yield currow, np.array(m[currow:currow + chunkrows])
+    del m
+
+def minmax_decimate(xmin, xmax, factor):
+    """
+    Return the min of xmin and the max of xmax over consecutive blocks of
+    ``factor`` rows. The last block may be shorter.
+    """
+    n, channels = xmin.shape
+    nfull = n // factor
+    nblocks = -(-n // factor)
+    ymin = np.empty((nblocks, channels), dtype=xmin.dtype)
+    ymax = np.empty((nblocks, channels), dtype=xmax.dtype)
+    ymin[:nfull] = xmin[:nfull * factor].reshape((nfull, factor, channels)).min(axis=1)
+    ymax[:nfull] = xmax[:nfull * factor].reshape((nfull, factor, channels)).max(axis=1)
+    if nblocks > nfull:
+        ymin[-1] = xmin[nfull * factor:].min(axis=0)
+        ymax[-1] = xmax[nfull * factor:].max(axis=0)
+    return ymin, ymax
+
+def iter_minmax_levels(x, factors):
+    """
+    Yield (factor, level) for each decimation factor, where level contains
+    the min and max of each block of ``factor`` rows of x, interleaved as
+    min, max, min, max... Each level is computed from the previous one when
+    its factor is a multiple of the previous factor.
+    """
+    xmin, xmax, prev = x, x, 1
+    for factor in sorted(factors):
+        if factor % prev == 0:
+            xmin, xmax = minmax_decimate(xmin, xmax, factor // prev)
+        else:
+            xmin, xmax = minmax_decimate(x, x, factor)
+        prev = factor
+        level = np.empty((2 * xmin.shape[0], x.shape[1]), dtype=x.dtype)
+        level[0::2] = xmin
+        level[1::2] = xmax
+        yield factor, level
+
+def create_pyramid(f5, totalrows, channels, freq, dtype, factors):
+    """
+    Create the min/max level datasets of a RawData dataset with totalrows
+    rows, in the "Pyramid" group of an HDF5 file.
+    """
+    group = f5.require_group("Pyramid")
+    levels = []
+    for factor in sorted(factors):
+        rows = 2 * (-(-totalrows // factor))
+        level = group.create_dataset("level%d" % factor, (rows, channels),
+                                     dtype=dtype)
+        level.attrs["factor"] = factor
+        level.attrs["channels"] = channels
+        # two rows (min and max) per block of factor rows
+        level.attrs["freq"] = 2. * freq / factor
+        level.attrs["duration"] = float(rows - 1) * factor / (2. * freq)
+        levels.append(level)
+    return levels
+
+def write_pyramid(levels, currow, x):
+    """
+    Write the min/max levels of the chunk x starting at row currow, which
+    must be a multiple of all decimation factors.
+    """
+    factors = [level.attrs["factor"] for level in levels]
+    for level, (factor, y) in zip(levels, iter_minmax_levels(x, factors)):
+        row = 2 * (currow // factor)
+        level.write_direct(y, dest_sel=np.s_[row:row + y.shape[0],:])
+
+def get_identity(dtype):
+    """
+    Return the values which change no min, and no max, of the given dtype.
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return info.max, info.min
+    return np.inf, -np.inf
+
+def build_segment_tree(tree, nblocks, fun, identity, chunkrows=2 ** 20):
+    """
+    Fill the internal nodes of a segment tree, a (2 * size) x channels
+    dataset or array whose leaves, the nodes size to size + nblocks - 1,
+    have been written, for the reduction fun (np.minimum or np.maximum).
+    size is the power of two above nblocks: the node i has the children 2i
+    and 2i+1. The nodes are computed ``chunkrows`` at a time, so that the
+    tree does not have to fit in memory.
+    """
+    size = tree.shape[0] // 2
+    # leaves beyond the blocks
+    for i in xrange(size + nblocks, 2 * size, chunkrows):
+        j = min(i + chunkrows, 2 * size)
+        tree[i:j] = np.full((j - i, tree.shape[1]), identity, dtype=tree.dtype)
+    tree[0] = np.full(tree.shape[1], identity, dtype=tree.dtype)
+    # one level at a time, from the leaves to the root
+    n = size // 2
+    while n >= 1:
+        for i in xrange(n, 2 * n, chunkrows):
+            j = min(i + chunkrows, 2 * n)
+            children = tree[2 * i:2 * j]
+            tree[i:j] = fun(children[0::2], children[1::2])
+        n //= 2
+
+def get_segment_nodes(size, b0, b1):
+    """
+    Return the sorted list of the O(log n) nodes of a segment tree which
+    cover the leaves b0 to b1 included.
+    """
+    nodes = []
+    l, r = b0 + size, b1 + size + 1
+    while l < r:
+        if l & 1:
+            nodes.append(l)
+            l += 1
+        if r & 1:
+            r -= 1
+            nodes.append(r)
+        l //= 2
+        r //= 2
+    return sorted(nodes)
+
+def create_minmax_index(data, blockrows=1024, chunkrows=2 ** 20):
+    """
+    Build the min/max index of RawData, in a file opened for writing: the
+    segment trees of the min and of the max of each channel over blocks of
+    ``blockrows`` rows, saved in the "MinMaxIndex" group. The blocks are
+    read ``chunkrows`` rows at a time from the min/max level with the same
+    factor if there is one, from RawData otherwise, and the trees are
+    written to the file as they are built, so that they do not have to fit
+    in memory.
+    """
+    f5 = data.file
+    nrows, channels = data.shape
+    nblocks = -(-nrows // blockrows)
+    size = 1
+    while size < nblocks:
+        size *= 2
+    if "MinMaxIndex" in f5:
+        del f5["MinMaxIndex"]
+    g = f5.create_group("MinMaxIndex")
+    g.attrs["blockrows"] = blockrows
+    g.attrs["nblocks"] = nblocks
+    tmin = g.create_dataset("min", (2 * size, channels), dtype=data.dtype)
+    tmax = g.create_dataset("max", (2 * size, channels), dtype=data.dtype)
+    # the leaves, one chunk of rows at a time
+    levels = dict(load_pyramid(data))
+    chunkblocks = max(1, chunkrows // blockrows)
+    for b0 in xrange(0, nblocks, chunkblocks):
+        b1 = min(b0 + chunkblocks, nblocks)
+        if blockrows in levels:
+            level = levels[blockrows][2 * b0:2 * b1]
+            bmin, bmax = level[0::2], level[1::2]
+        else:
+            x = data[b0 * blockrows:b1 * blockrows]
+            bmin, bmax = minmax_decimate(x, x, blockrows)
+        tmin[size + b0:size + b1] = bmin
+        tmax[size + b0:size + b1] = bmax
+    vmin, vmax = get_identity(data.dtype)
+    build_segment_tree(tmin, nblocks, np.minimum, vmin, chunkrows)
+    build_segment_tree(tmax, nblocks, np.maximum, vmax, chunkrows)
+
+class MinMaxIndex(object):
+    """
+    Min and max of the channels of RawData over any range of rows, with
+    O(log n) reads of the segment trees saved by ``create_minmax_index``.
+    The range is extended to whole blocks, so the returned range contains
+    the exact one.
+    """
+    def __init__(self, group):
+        self.tmin = group["min"]
+        self.tmax = group["max"]
+        self.blockrows = int(group.attrs["blockrows"])
+        self.nblocks = int(group.attrs["nblocks"])
+        self.size = self.tmin.shape[0] // 2
+        
+    def query(self, fromrow, torow, channels=None):
+        """
+        Return the (min, max) arrays of the given channels (see
+        ``get_channel_selection``) over the rows fromrow to torow included,
+        or None if no row is in the index. The rows beyond the last block,
+        which do not exist, are ignored.
+        """
+        b0 = max(fromrow, 0) // self.blockrows
+        b1 = min(torow // self.blockrows, self.nblocks - 1)
+        if b1 < b0:
+            return None
+        nodes = get_segment_nodes(self.size, b0, b1)
+        sel = get_channel_selection(channels)
+        vmin = self.tmin[nodes][:, sel].min(axis=0)
+        vmax = self.tmax[nodes][:, sel].max(axis=0)
+        return vmin, vmax
+
+def load_minmax_index(data):
+    """
+    Return the MinMaxIndex of RawData, or None if it has not been created.
+    """
+    if "MinMaxIndex" not in data.file:
+        return None
+    return MinMaxIndex(data.file["MinMaxIndex"])
+
+class ChannelStats(object):
+    """
+    Per-channel min, max, mean, standard deviation and number of clipped
+    samples (equal to the min or max value of an integer dtype), accumulated
+    chunk by chunk.
+    """
+    blockrows = 65536  # rows converted to float64 at once
+    
+    def __init__(self, channels, dtype):
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.min = np.zeros(channels, dtype=self.dtype)
+        self.max = np.zeros(channels, dtype=self.dtype)
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)  # sum of squared deviations to the mean
+        self.clipped = np.zeros(channels, dtype=np.int64)
+        if self.dtype.kind in "iu":
+            info = np.iinfo(self.dtype)
+            self.clip = (info.min, info.max)
+        else:
+            self.clip = None
+        
+    def update(self, x):
+        for i in xrange(0, x.shape[0], self.blockrows):
+            self.update_block(x[i:i + self.blockrows])
+        
+    def update_block(self, x):
+        n = x.shape[0]
+        if n == 0:
+            return
+        if self.count == 0:
+            self.min = x.min(axis=0)
+            self.max = x.max(axis=0)
+        else:
+            self.min = np.minimum(self.min, x.min(axis=0))
+            self.max = np.maximum(self.max, x.max(axis=0))
+        if self.clip is not None:
+            self.clipped += (x == self.clip[0]).sum(axis=0)
+            self.clipped += (x == self.clip[1]).sum(axis=0)
+        # merge the mean and m2 of the block with the current ones
+        xf = np.array(x, dtype=np.float64)
+        mean = xf.mean(axis=0)
+        xf -= mean
+        m2 = np.einsum('ij,ij->j', xf, xf)
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta ** 2 * self.count * n / count
+        self.count = count
+        
+    def get_std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+        
+    def read_attrs(self, attrs, count):
+        """
+        Restore the statistics of the first count rows, saved with
+        write_attrs.
+        """
+        self.count = count
+        self.min = attrs["min"]
+        self.max = attrs["max"]
+        self.mean = np.array(attrs["mean"], dtype=np.float64)
+        self.m2 = np.array(attrs["std"], dtype=np.float64) ** 2 * count
+        self.clipped = np.array(attrs["clipped"], dtype=np.int64)
+        
+    def write_attrs(self, attrs):
+        attrs["min"] = self.min
+        attrs["max"] = self.max
+        attrs["mean"] = self.mean
+        attrs["std"] = self.get_std()
+        attrs["clipped"] = self.clipped
+
+def iter_threaded(chunks, queuesize=4):
+    """
+    Consume a chunk generator in a reader thread, through a bounded queue,
+    so that reading the next chunks overlaps with processing the current one.
+    """
+    queue = Queue.Queue(maxsize=queuesize)
+    done = object()
+    stop = threading.Event()
+    error = []  # exc_info of the reader
     
+    def put(item):
+        # do not block forever if the consumer has gone away
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
     
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    break
+        except Exception:
+            error.append(sys.exc_info())
+        put(done)
+        
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+    if error:
+        # with the traceback of the reader thread
+        raise error[0][0], error[0][1], error[0][2]
+
+
+# compression filters tried by autotune_layout, as create_dataset arguments:
+# no compression, the fast lzf and several levels of gzip, each with and
+# without the shuffle filter, which often helps on integer samples
+COMPRESSIONS = [
+    dict(compression="lzf"),
+    dict(compression="gzip", compression_opts=1),
+    dict(compression="gzip", compression_opts=4),
+    dict(compression="gzip", compression_opts=9),
+    ]
+FILTERS = [dict()] + [dict(shuffle=shuffle, **compression)
+                      for compression in COMPRESSIONS
+                      for shuffle in (False, True)]
+
+def get_layout_candidates(channels, freq):
+    """
+    Return the list of chunk shapes and filters tried by autotune_layout.
+    """
+    shapes = []
+    for chunkdur in (.25, 1.):
+        rows = max(1, int(chunkdur * freq))
+        shapes.append((rows, channels))
+        if channels > 16:
+            shapes.append((rows, 16))
+    return [dict(chunks=shape, **filters)
+            for shape in shapes for filters in FILTERS]
+
+def get_chunk_reads(layout, shape, windows):
+    """
+    Return the number of chunks of the given layout read by the windows,
+    a list of (fromrow, torow) over all the channels.
+    """
+    rows, cols = layout["chunks"]
+    colchunks = -(-shape[1] // cols)
+    return sum((min(torow, shape[0] - 1) // rows - fromrow // rows + 1) *
+               colchunks for fromrow, torow in windows)
+
+def autotune_layout(fromfile, channels, freq, dtype, sampledur=10.,
+                    nreads=20, readdur=(1., 3.), diskspeed=100e6):
+    """
+    Find the chunk shape and compression filter of RawData that minimize the
+    time taken by ``read_hdf5`` on time windows of ``readdur`` seconds, read
+    from a disk reading ``diskspeed`` bytes per second.
+    Each candidate layout is written with ``sampledur`` seconds from the
+    middle of the DAT file to a temporary HDF5 file, which is then read at
+    ``nreads`` random positions, the same for all candidates. The temporary
+    file is in the page cache, so these reads only measure the decompression;
+    the time to read the stored bytes of the chunks of the windows from the
+    disk is added to it.
+    Return the best layout as a dict of create_dataset arguments.
+    """
+    totalrows = get_totalrows(fromfile, channels, dtype)
+    m = np.memmap(fromfile, dtype=dtype, mode="r", shape=(totalrows, channels))
+    samplerows = min(totalrows, int(sampledur * freq))
+    start = (totalrows - samplerows) // 2
+    sample = np.array(m[start:start + samplerows])
+    del m
+    duration = float(samplerows - 1) / freq
+    # same windows for all the candidates
+    rnd = np.random.RandomState(0)
+    durations = rnd.uniform(readdur[0], readdur[1], nreads)
+    durations = np.minimum(durations, duration)
+    fromtimes = rnd.uniform(0, 1, nreads) * (duration - durations)
+    windows = [(int(round(fromtime * freq)),
+                int(round((fromtime + dur) * freq)))
+               for fromtime, dur in zip(fromtimes, durations)]
+
+    fd, tmpfile = tempfile.mkstemp(suffix=".h5")
+    os.close(fd)
+    best, besttime = None, None
+    try:
+        for layout in get_layout_candidates(channels, freq):
+            rows, cols = layout["chunks"]
+            layout["chunks"] = (min(rows, samplerows), cols)
+            f5 = h5py.File(tmpfile, "w")
+            d = f5.create_dataset("RawData", data=sample, **layout)
+            d.attrs["freq"] = freq
+            d.attrs["channels"] = channels
+            f5.close()
+            f5 = h5py.File(tmpfile, "r")
+            d = f5["RawData"]
+            t0 = time.time()
+            for fromtime, dur in zip(fromtimes, durations):
+                read_hdf5(d, fromtime, dur)
+            readtime = time.time() - t0
+            # average stored size of a chunk
+            nchunks = get_chunk_reads(layout, d.shape, [(0, d.shape[0] - 1)])
+            chunksize = d.id.get_storage_size() / float(nchunks)
+            f5.close()
+            readtime += get_chunk_reads(layout, sample.shape, windows) * \
+                        chunksize / diskspeed
+            if besttime is None or readtime < besttime:
+                best, besttime = layout, readtime
+    finally:
+        os.remove(tmpfile)
+    return best
+
+PYRAMID = (4, 16, 64, 256, 1024, 4096)
+
+# default size in bytes of the RawData chunks, the size of the default HDF5
+# chunk cache, so that the chunk read by a window can be kept in it
+CHUNKBYTES = 2 ** 20
+
+def get_chunk_shape(channels, freq, dtype, chunkdur=1.):
+    """
+    Return the default chunk shape of RawData: ``chunkdur`` seconds of all
+    the channels, or fewer rows if that exceeds CHUNKBYTES bytes. Time
+    windows over all the channels then read a few contiguous chunks.
+    """
+    rows = min(int(chunkdur * freq),
+               CHUNKBYTES // (channels * np.dtype(dtype).itemsize))
+    return (max(1, rows), channels)
 
-def convert_to_hdf5(fromfile, tofile, channels, freq, dtype=None):
+def convert_to_hdf5(fromfile, tofile, channels, freq, dtype=None, mmap=False,
+                    queuesize=4, pyramid=None, autotune=False, stats=False,
+                    resume=False, index=False, report="text"):
     """
     Convert a binary array file, in the format of neuroscope, to a HDF5 file,
     useful for reading the array efficiently from the disk without loading the
@@ -49,40 +609,199 @@ def convert_to_hdf5(fromfile, tofile, channels, freq, dtype=None):
         
         Numpy dtype of the DAT file, also used for the HDF5 file.
         By default: int16 (2 bytes/sample).
+    
+    ``mmap``
+        
+        If True, memory-map the DAT file, create the HDF5 dataset at its
+        final size up front, and read the next chunks in a separate thread
+        while the current one is written to the HDF5 file.
+        
+    ``queuesize``
+        
+        Maximum number of chunks read in advance when ``mmap`` is True.
+        
+    ``pyramid``
+        
+        If not None, list of decimation factors of the min/max levels to
+        write in the "Pyramid" group next to RawData, or True for the
+        default factors 4, 16, 64, ... 4096. Each level contains the min
+        and the max of every block of ``factor`` rows, interleaved.
+        
+    ``autotune``
+        
+        If True, benchmark several chunk shapes and compression filters with
+        a sample of the DAT file (see ``autotune_layout``), create RawData
+        with the fastest one to read, and save it in the attributes
+        "chunks", "compression", "compression_opts" and "shuffle".
+        Otherwise RawData is stored uncompressed, in the chunks returned by
+        ``get_chunk_shape``, with or without ``mmap``.
+        
+    ``stats``
+        
+        If True, compute the min, max, mean, standard deviation and number of
+        clipped samples of each channel during the conversion, and save them
+        in the attributes "min", "max", "mean", "std" and "clipped" of
+        RawData (see ``ChannelStats``).
+        
+    ``resume``
+        
+        If True and the HDF5 file exists, continue an interrupted conversion
+        from the last row committed to it, with the same options. The number
+        of committed rows and the size of the DAT file are saved in the
+        attributes "lastrow" and "sourcesize" of RawData after each chunk.
+        The DAT file must have the same size, and its last committed rows
+        must be identical to the ones in the HDF5 file, the pyramid must
+        have the same factors, and ``stats`` must be True if the HDF5 file
+        has stats.
+        
+    ``index``
+        
+        If True, or a number of rows per block, create the min/max index of
+        RawData at the end of the conversion (see ``create_minmax_index``),
+        used to find the range of the channels over any time window.
+        
+    ``report``
+        
+        A ProgressReporter, or the ``report`` argument of a new one.
     """
     if dtype is None:
         dtype = np.dtype(np.int16)
-    itemsize = dtype.itemsize  # number of bytes per item
+    dtype = np.dtype(dtype)
     chunkdur = 60  # duration in seconds of each chunk to load
-    chunksize = chunkdur * freq * itemsize * channels
-    totalsize = os.path.getsize(fromfile)  # size in bytes of fromfile
-    totalrows = totalsize / (itemsize * channels)  # total number of rows
-    f = open(fromfile, "rb")  # open from file
-    f5 = h5py.File(tofile)  # open to file
-    # create a HDF5 dataset with extendable size
-    d = f5.create_dataset("RawData", (0, channels), \
-                          dtype=dtype, maxshape=(None, channels))
-    # attributes
-    d.attrs["channels"] = channels  # number of channels
-    d.attrs["freq"] = freq  # sampling frequency
-    d.attrs["duration"] = float(totalrows - 1)/freq
-    currow = 0
-    print "Convert binary file <%s> to HDF5 file <%s>" % (fromfile, tofile)
-    report = ProgressReporter("text")
+    chunkrows = int(chunkdur * freq)  # number of rows in each chunk
+    if pyramid is True:
+        pyramid = PYRAMID
+    if pyramid:
+        # chunks must be aligned on the blocks of all levels
+        align = reduce(lambda a, b: a * b // gcd(a, b), pyramid)
+        chunkrows = -(-chunkrows // align) * align
+    totalrows = get_totalrows(fromfile, channels, dtype)  # total number of rows
+    sourcesize = os.path.getsize(fromfile)
+    if resume and os.path.exists(tofile):
+        f5 = h5py.File(tofile, "r+")
+        try:
+            d, fromrow = check_resume(f5, fromfile, channels, dtype, freq)
+        except:
+            f5.close()
+            raise
+        factors = tuple(factor for factor, level in load_pyramid(d))
+        if factors != tuple(pyramid or ()):
+            f5.close()
+            if not factors:
+                raise ValueError("<%s> has been converted without pyramid" \
+                                 % tofile)
+            raise ValueError("<%s> has been converted with the pyramid %s" \
+                             % (tofile, factors))
+        if pyramid:
+            levels = [level for factor, level in load_pyramid(d)]
+        if stats:
+            channelstats = ChannelStats(channels, dtype)
+            if fromrow > 0:
+                if "std" not in d.attrs:
+                    f5.close()
+                    raise ValueError("<%s> has been converted without stats" \
+                                     % tofile)
+                channelstats.read_attrs(d.attrs, fromrow)
+        elif "std" in d.attrs:
+            # the stats of the first part would be kept for the whole file
+            f5.close()
+            raise ValueError("<%s> has been converted with stats" % tofile)
+        print "Resume the conversion of <%s> to <%s> at row %d/%d" % \
+              (fromfile, tofile, fromrow, totalrows)
+    else:
+        fromrow = 0
+        layout = dict()
+        if autotune and totalrows > 0:
+            print "Autotune the layout of <%s>" % tofile
+            layout = autotune_layout(fromfile, channels, freq, dtype)
+        # explicit chunks, since the shape guessed by h5py from the final
+        # size of the mmap dataset has one chunk per channel
+        chunks = layout.pop("chunks", get_chunk_shape(channels, freq, dtype))
+        if totalrows > 0:
+            chunks = (min(chunks[0], totalrows), chunks[1])
+        f5 = h5py.File(tofile)  # open to file
+        # the HDF5 dataset is created at its final size with mmap, and
+        # extended chunk after chunk otherwise
+        d = f5.create_dataset("RawData", (totalrows if mmap else 0, channels), \
+                              dtype=dtype, maxshape=(None, channels), \
+                              chunks=chunks, **layout)
+        # attributes
+        d.attrs["channels"] = channels  # number of channels
+        d.attrs["freq"] = freq  # sampling frequency
+        d.attrs["duration"] = float(totalrows - 1)/freq
+        d.attrs["sourcesize"] = sourcesize  # size in bytes of the DAT file
+        d.attrs["lastrow"] = 0  # number of rows committed to the HDF5 file
+        if autotune:
+            d.attrs["chunks"] = d.chunks
+            d.attrs["compression"] = d.compression or "none"
+            d.attrs["compression_opts"] = d.compression_opts or 0
+            d.attrs["shuffle"] = d.shuffle
+        if pyramid:
+            levels = create_pyramid(f5, totalrows, channels, freq, dtype, pyramid)
+        if stats:
+            channelstats = ChannelStats(channels, dtype)
+        print "Convert binary file <%s> to HDF5 file <%s>" % (fromfile, tofile)
+    if mmap:
+        if d.shape[0] < totalrows:
+            d.resize(totalrows, axis=0)
+        chunks = iter_threaded(iter_mmap_chunks(fromfile, channels, dtype,
+                                                chunkrows, fromrow), queuesize)
+    else:
+        chunks = iter_chunks(fromfile, channels, dtype, chunkrows, fromrow)
+    if not isinstance(report, ProgressReporter):
+        report = ProgressReporter(report)
     report.start()
-    while True:
-        s = f.read(chunksize)  # read chunksize bytes from the to file
-        if not s:
-            break
-        x = np.fromstring(s, dtype=dtype)  # convert to a Numpy array
-        x = x.reshape((-1, channels))  # and resize it
-        h = x.shape[0]
-        d.resize(currow + h, axis=0)  # extend the HDF5 file
-        d[currow:currow + h,:] = x  # put the temp array in the HDF5 file
-        report.update(float(currow)/totalrows)
-        currow += h
-    f.close()
-    f5.close()
+    try:
+        for currow, x in chunks:
+            h = x.shape[0]
+            if d.shape[0] < currow + h:
+                d.resize(currow + h, axis=0)  # extend the HDF5 file
+            # put the temp array in the HDF5 file
+            d.write_direct(x, dest_sel=np.s_[currow:currow + h,:])
+            if pyramid:
+                write_pyramid(levels, currow, x)
+            if stats:
+                channelstats.update(x)
+            # commit the chunk before recording the progress
+            f5.flush()
+            if stats:
+                channelstats.write_attrs(d.attrs)
+            d.attrs["lastrow"] = currow + h
+            f5.flush()
+            report.update(float(currow)/totalrows)
+        if index:
+            create_minmax_index(d, blockrows=1024 if index is True else index)
+    finally:
+        f5.close()
     report.finish()
 
-
+def check_resume(f5, fromfile, channels, dtype, freq, overlapdur=1.):
+    """
+    Return the RawData dataset of a partially converted HDF5 file and the
+    row from which to resume, after checking that the DAT file has not
+    changed: same size, and same last ``overlapdur`` seconds before the last
+    committed row, and that the sampling frequency is the same. Raise a
+    ValueError otherwise.
+    """
+    if "RawData" not in f5 or "lastrow" not in f5["RawData"].attrs:
+        raise ValueError("<%s> is not a resumable conversion" % f5.filename)
+    d = f5["RawData"]
+    if d.shape[1] != channels or d.dtype != dtype:
+        raise ValueError("<%s> has not been converted with %d channels of %s" \
+                         % (f5.filename, channels, dtype))
+    if d.attrs["freq"] != freq:
+        raise ValueError("<%s> has been converted at %g Hz" \
+                         % (f5.filename, d.attrs["freq"]))
+    if d.attrs["sourcesize"] != os.path.getsize(fromfile):
+        raise ValueError("<%s> has changed since the last conversion" % fromfile)
+    lastrow = int(d.attrs["lastrow"])
+    overlaprows = min(lastrow, int(overlapdur * freq))
+    if overlaprows > 0:
+        totalrows = get_totalrows(fromfile, channels, dtype)
+        m = np.memmap(fromfile, dtype=dtype, mode="r", shape=(totalrows, channels))
+        source = np.array(m[lastrow - overlaprows:lastrow])
+        del m
+        if not np.array_equal(source, d[lastrow - overlaprows:lastrow]):
+            raise ValueError("<%s> has changed since the last conversion" \
+                             % fromfile)
+    return d, lastrow
@@ -1,8 +1,13 @@
+import time
 import numpy as np
 from navigation import Navigation
 
 class NavigationBuffered(Navigation):
     txmax = 1  # max translation
+    
+    # smoothed x velocity of the view, in data units per second
+    velocity = 0.
+    lastx, lastt = None, None
         
     def set_offsetx(self, x):
         self.offsetx = x
@@ -15,6 +20,22 @@ class NavigationBuffered(Navigation):
             return True
         return False
         
+    def update_velocity(self, smoothing=.5, timeout=.5):
+        """
+        Update the velocity of the view with its current position, and
+        return it. The velocity is reset when the view has not been updated
+        for timeout seconds.
+        """
+        x, _ = self.get_data_coordinates()
+        t = time.time()
+        if self.lastt is None or t - self.lastt > timeout:
+            self.velocity = 0.
+        elif t > self.lastt:
+            v = (x - self.lastx) / (t - self.lastt)
+            self.velocity = smoothing * self.velocity + (1. - smoothing) * v
+        self.lastx, self.lastt = x, t
+        return self.velocity
+        
     def get_slide(self, max):
         v = int(max * (.5 * (1. - 1. / self.sx) - self.xmin - self.tx) / (self.xmax - self.xmin - 1. / self.sx))
         return v
@@ -0,0 +1,97 @@
+"""
+Decimation of many channels with a pool of processes, each one handling
+a group of channels. The input and output arrays are in shared memory,
+so that only the bounds of the groups are sent to the processes.
+"""
+import multiprocessing
+import numpy as np
+from decimation import decimate, get_decimated_rows
+
+# shared arrays of the worker processes
+SHARED = {}
+
+def init_worker(input, indices, values, dtype):
+    SHARED.update(input=input, indices=indices, values=values,
+                  dtype=np.dtype(dtype))
+
+def as_array(buffer, shape, dtype):
+    return np.frombuffer(buffer, dtype=dtype,
+                         count=int(np.prod(shape))).reshape(shape)
+
+def decimate_group(args):
+    """
+    Decimate the channels c0:c1 of the shared input, and write the result
+    into the same columns of the shared outputs.
+    """
+    n, nchannels, c0, c1, width, method = args
+    dtype = SHARED["dtype"]
+    y = as_array(SHARED["input"], (n, nchannels), dtype)
+    indices, values = decimate(y[:, c0:c1], width, method)
+    rows = indices.shape[0]
+    as_array(SHARED["indices"], (rows, nchannels), np.intp)[:, c0:c1] = indices
+    as_array(SHARED["values"], (rows, nchannels), dtype)[:, c0:c1] = values
+    return c0, c1
+
+class ParallelDecimator(object):
+    """
+    Drop-in replacement of decimation.decimate which splits the channels
+    into groups decimated by ``workers`` processes (by default, one per
+    CPU). The shared arrays hold ``size`` values of the given dtype, and
+    are allocated again when a larger array or another dtype is decimated,
+    which restarts the processes. With a single worker, the decimation is
+    done in the calling process.
+    """
+    def __init__(self, workers=None, size=2 ** 22, dtype=np.float32):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.pool = None
+        if workers > 1:
+            self.allocate(size)
+
+    def allocate(self, size, dtype=None):
+        self.close()
+        self.size = size
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        # RawArray: no lock, the processes write disjoint columns
+        self.input = multiprocessing.RawArray('b', size * self.dtype.itemsize)
+        self.indices = multiprocessing.RawArray('b', size * np.dtype(np.intp).itemsize)
+        self.values = multiprocessing.RawArray('b', size * self.dtype.itemsize)
+        self.pool = multiprocessing.Pool(self.workers, init_worker,
+            (self.input, self.indices, self.values, self.dtype.str))
+
+    def get_groups(self, nchannels):
+        # contiguous groups of channels, one per worker
+        bounds = np.linspace(0, nchannels, min(self.workers, nchannels) + 1)
+        bounds = np.round(bounds).astype(int)
+        return zip(bounds[:-1], bounds[1:])
+
+    def decimate(self, y, width, method="m4"):
+        """
+        Decimate y, a N x channels array, for width pixel columns. Return
+        (indices, values), like decimation.decimate.
+        """
+        n, nchannels = y.shape
+        rows = get_decimated_rows(n, width, method)
+        if self.workers <= 1 or nchannels <= 1:
+            return decimate(y, width, method)
+        size = max(n, rows) * nchannels
+        if size > self.size or y.dtype != self.dtype:
+            self.allocate(max(size, self.size), y.dtype)
+        as_array(self.input, (n, nchannels), self.dtype)[...] = y
+        tasks = [(n, nchannels, c0, c1, width, method)
+                 for c0, c1 in self.get_groups(nchannels)]
+        self.pool.map(decimate_group, tasks)
+        # copies, the shared arrays are overwritten by the next call
+        indices = np.array(as_array(self.indices, (rows, nchannels), np.intp))
+        values = np.array(as_array(self.values, (rows, nchannels), self.dtype))
+        return indices, values
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
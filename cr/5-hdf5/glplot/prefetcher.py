@@ -0,0 +1,52 @@
+import logging
+import threading
+import Queue
+
+log = logging.getLogger(__name__)
+
+class Prefetcher(object):
+    """
+    Load data buffers ahead of the view with DataProxy.prefetch, on a worker
+    thread. Only the latest request is kept: a new request replaces the
+    pending one and interrupts the one being loaded between two buffers.
+    """
+    def __init__(self, dataproxy):
+        self.dataproxy = dataproxy
+        self.requests = Queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def request(self, databuffers, channels=None, step=None):
+        self.put((databuffers, channels, step))
+        
+    def put(self, task):
+        # replace the pending request, if any
+        try:
+            self.requests.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            self.requests.put_nowait(task)
+        except Queue.Full:
+            pass
+        
+    def run(self):
+        while True:
+            task = self.requests.get()
+            if task is None:
+                return
+            databuffers, channels, step = task
+            for databuffer in databuffers:
+                if not self.requests.empty():
+                    break  # obsolete
+                try:
+                    self.dataproxy.prefetch(databuffer, channels=channels,
+                                            step=step)
+                except Exception:
+                    log.exception("Prefetch of (%.1fs, %.1fs) failed",
+                                  databuffer[0], databuffer[1])
+        
+    def stop(self):
+        self.put(None)
+        self.thread.join()
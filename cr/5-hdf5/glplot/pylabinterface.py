@@ -5,6 +5,7 @@ from glwidget import GLWidget
 from glplotwin import GLPlot
 from colors import LINECOLORS, get_color
 from signals import SIGNALS
+from decimation import lttb
 
 def in_ipython():
     try:
@@ -46,13 +47,21 @@ def get_options(opt, lw):
 
     
 class Line(object):
-    def __init__(self, x, y=None, opt=None, lw=1.0):
+    def __init__(self, x, y=None, opt=None, lw=1.0, npoints=None):
+        """
+        If npoints is not None, the line is downsampled to npoints points
+        with the Largest-Triangle-Three-Buckets algorithm.
+        """
         if type(y) is str:
             opt = y
             y = None
         if y is None:
             y = x.copy()
             x = np.arange(0, len(y))
+        
+        if npoints is not None and len(y) > npoints:
+            indices, y = lttb(np.reshape(y, (-1, 1)), npoints, x=x)
+            x = np.asarray(x)[indices[:, 0]]
 
         x = x.reshape((-1,1))
         y = y.reshape((-1,1))
@@ -148,13 +157,13 @@ def clear(windowIndex=None):
     else:
         close_window(windowIndex)
         
-def plot(x, y=None, opt=None, lw=1.0):
+def plot(x, y=None, opt=None, lw=1.0, npoints=None):
     global WINDOWS
     if len(WINDOWS)==0:
         figure()
     w = get_last_window()
     # print "plot", w
-    w.plot(x, y, opt, lw)
+    w.plot(x, y, opt, lw, npoints)
     
     # if w.interactive:
         # w.show()
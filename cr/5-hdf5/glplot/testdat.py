@@ -0,0 +1,12 @@
+import numpy as np
+from glplotwin import *
+from glwidgetbuffered import GLWidgetBuffered
+
+# view a neuroscope DAT file directly, without converting it to HDF5
+freq = 20000.
+channels = 32
+data = "test.dat"
+
+glplot = GLPlot(False, 0, GLWidgetBuffered)
+glplot.glWidget.load_data(data, freq=freq, channels=channels, dtype=np.int16)
+glplot.show()